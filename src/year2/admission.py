@@ -0,0 +1,123 @@
+import asyncio
+import contextlib
+import logging
+from collections import deque
+
+# Configure the logger
+logger = logging.getLogger('discord.admission')
+logger.setLevel(logging.INFO)
+
+# Cost of each command in units of the global budget, everything else costs default_cost
+command_costs = {
+    "explain": 1,
+    "link": 1,
+    "unlink": 1,
+    "points": 2,
+    "breakdown": 2,
+    "ranking": 3,
+    "leaderboard": 3,
+}
+default_cost = 1
+
+# Cost of a full leaderboard, which has to resolve every entry
+full_leaderboard_cost = 8
+
+
+def command_cost(name, args):
+    if name == "leaderboard" and len(args) > 0 and args[0] in ["all", "csv"]:
+        return full_leaderboard_cost
+    return command_costs.get(name, default_cost)
+
+
+class Rejected(Exception):
+    """A command was not admitted, the message says why"""
+
+
+class AdmissionController:
+    """
+    Admission for bot commands. Running commands share a budget of cost units,
+    commands that do not fit wait in order in a bounded queue, and every user can only have a few
+    commands running or waiting at once. When the queue is full, new commands are turned away.
+    """
+
+    def __init__(self, budget, per_user, max_queue):
+        self.budget = budget
+        self.per_user = per_user
+        self.max_queue = max_queue
+
+        self.used = 0
+        self.users = {}
+        self.waiting = deque()
+        self.condition = asyncio.Condition()
+        self.admitted = 0
+        self.rejected = 0
+
+    def check(self, user_id, cost):
+        """Turn away commands that can not be queued, returns the queue position of the command or 0"""
+        if self.users.get(user_id, 0) >= self.per_user:
+            raise Rejected("You already have commands running, please wait for them to finish.")
+
+        if len(self.waiting) == 0 and self.used + cost <= self.budget:
+            return 0
+
+        if len(self.waiting) >= self.max_queue:
+            raise Rejected("The bot is busy right now, please try again in a bit.")
+
+        return len(self.waiting) + 1
+
+    async def acquire(self, ctx, cost):
+        user_id = ctx.author.id
+        cost = min(cost, self.budget)
+        try:
+            position = self.check(user_id, cost)
+        except Rejected:
+            self.rejected += 1
+            raise
+
+        self.users[user_id] = self.users.get(user_id, 0) + 1
+        entry = object()
+        self.waiting.append(entry)
+        try:
+            if position > 0:
+                await ctx.send(f"Queued, position {position}.")
+
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.waiting[0] is entry and self.used + cost <= self.budget)
+                self.waiting.popleft()
+                self.used += cost
+                self.admitted += 1
+                self.condition.notify_all()
+        except BaseException:
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+                self.release_user(user_id)
+                async with self.condition:
+                    self.condition.notify_all()
+            raise
+
+    async def release(self, user_id, cost):
+        async with self.condition:
+            self.used -= min(cost, self.budget)
+            self.release_user(user_id)
+            self.condition.notify_all()
+
+    def release_user(self, user_id):
+        self.users[user_id] -= 1
+        if self.users[user_id] == 0:
+            del self.users[user_id]
+
+    @contextlib.asynccontextmanager
+    async def admit(self, ctx, cost):
+        """Run a command once it is admitted, raises Rejected if it is turned away"""
+        await self.acquire(ctx, cost)
+        try:
+            yield
+        finally:
+            await self.release(ctx.author.id, cost)
+
+    def stats(self):
+        return {"used": self.used, "budget": self.budget, "waiting": len(self.waiting), "users": len(self.users),
+                "admitted": self.admitted, "rejected": self.rejected}
+
+
+admission = AdmissionController(budget=10, per_user=2, max_queue=20)
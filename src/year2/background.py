@@ -1,62 +1,229 @@
 import asyncio
 import logging
-import ssl
-from datetime import datetime
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 import aiohttp
-import certifi
 from aiohttp.abc import HTTPException
 from discord.ext import tasks
 
-from models import Entry
-from points import get_total_score, get_collated_scores
+from batch_scoring import score_kills_batch
+from models import Entry, KillCursor
+from network import get_kill_pages, get_affiliations, get_group_kill_pages, known_kills, linked_characters, \
+    prune_killmails
+from pipeline import Pipeline, Stage
+from scheduling import recent_kills, schedule_entry, store_refreshed_entries
+from points import get_total_score, get_kill_scores, get_unscored_kills, collate_character_scores, \
+    prune_kill_scores
 
 # Configure the logger
 logger = logging.getLogger('discord.background')
 logger.setLevel(logging.INFO)
 
-ssl_context = ssl.create_default_context(cafile=certifi.where())
+
+# Stats of the most recent refresh pipeline
+refresh_pipeline = None
+
+# Stats of the refresh loop
+refresh_loop_stats = {"runs": 0, "entries": 0, "failed": 0, "last_duration": 0.0}
+
+refresh_errors = (ValueError, AttributeError, TimeoutError, aiohttp.http_exceptions.BadHttpMessage)  # noqa
+
+# Entries due this soon are refreshed together
+refresh_ahead = timedelta(minutes=2)
+
+# Least time between two refresh runs, in seconds
+min_sleep = 60
+
+# Refreshed entries written per transaction
+persist_batch_size = 20
+
+# Corporations / alliances with at least this many entrants are crawled as a whole
+group_min_members = 3
+
+# Time of the last live update of each character, refreshes that started before it are not persisted
+live_updates = {}
+
+
+async def discover_groups(session, rules, entries):
+    """
+    Crawl the kills of corporations and alliances that several entrants share, instead of each entrant.
+    Corporations are preferred, as alliances bring more kills without any entrant on them.
+    Returns the oldest kill id to use for each character covered by a group, and the affiliations of all entries.
+
+    Group pages only hold the kills since the character joined the group, so a character is only covered
+    once it was crawled on its own back to the season start while it was in the group already.
+    All others are still crawled on their own.
+    """
+    character_ids = [int(entry.character_id) for entry in entries]
+    try:
+        affiliations = await get_affiliations(session, character_ids)
+    except refresh_errors:
+        logger.warning("Could not fetch affiliations, crawling every entry on its own.", exc_info=True)
+        return {}, {}
+
+    groups = []
+    remaining = set(affiliations)
+    for entity, index in [("corporationID", 0), ("allianceID", 1)]:
+        members = defaultdict(set)
+        for character_id in remaining:
+            if affiliations[character_id][index] is not None:
+                members[affiliations[character_id][index]].add(character_id)
+        for group_id, group_members in members.items():
+            if len(group_members) >= group_min_members:
+                groups.append((entity, group_id, group_members))
+                remaining -= group_members
+
+    covered = {}
+    for entity, group_id, group_members in groups:
+        try:
+            oldest_kill_id = await get_group_kill_pages(session, entity, group_id, start=rules.season.start)
+        except refresh_errors:
+            logger.warning(f"Could not crawl {entity} {group_id}, crawling its members on their own.", exc_info=True)
+            continue
+        if oldest_kill_id is None:
+            continue
+        cursor_group = KillCursor.corporation_id if entity == "corporationID" else KillCursor.alliance_id
+        cursors = KillCursor.select().where(KillCursor.character_id.in_(list(group_members)) &
+                                            (KillCursor.start == rules.season.start) & (cursor_group == group_id))
+        covered.update({cursor.character_id: min(oldest_kill_id, cursor.oldest_kill_id) for cursor in cursors})
+
+    # Most killmails of a group have no linked character on them
+    if len(groups) > 0:
+        logger.info(f"Pruned {prune_killmails()} killmails without linked characters.")
+
+    logger.info(f"Crawled {len(groups)} groups covering {len(covered)} of {len(character_ids)} entries.")
+    return covered, affiliations
+
+
+def build_refresh_pipeline(session, rules, max_delay, covered=None, affiliations=None):
+    """
+    Refresh pipeline for entries: page discovery -> killmail fetch -> scoring -> DB persist
+    Entries covered by a group crawl skip their own page discovery,
+    all others note their affiliation on their cursor after it.
+    """
+    covered = covered or {}
+    affiliations = affiliations or {}
+
+    # Time each entry started its refresh
+    started = {}
+
+    async def discover(entry):
+        started[int(entry.character_id)] = time.monotonic()
+        if int(entry.character_id) in covered:
+            return entry, known_kills(int(entry.character_id), covered[int(entry.character_id)])
+        kills = await get_kill_pages(session, int(entry.character_id), start=rules.season.start)
+        if int(entry.character_id) in affiliations:
+            corporation_id, alliance_id = affiliations[int(entry.character_id)]
+            KillCursor.update(corporation_id=corporation_id, alliance_id=alliance_id).where(
+                KillCursor.character_id == int(entry.character_id)).execute()
+        return entry, kills
+
+    async def fetch(entry, kills):
+        kill_data = await get_unscored_kills(session, rules, int(entry.character_id), kills)
+        return entry, kills, kill_data
+
+    async def score(entry, kills, kill_data):
+        # New kills are scored in one batch, all others come from the score cache
+        await score_kills_batch(session, rules, int(entry.character_id), kill_data)
+        kill_scores = await get_kill_scores(session, rules, int(entry.character_id), kills, {})
+        user_score = get_total_score(collate_character_scores(rules, int(entry.character_id), kill_scores))
+        return entry, user_score, recent_kills(kill_scores)
+
+    # Refreshed entries are written in batches, each in one transaction
+    refreshed_entries = []
+    activities = []
+
+    def is_stale(entry):
+        character_id = int(entry.character_id)
+        return live_updates.get(character_id, float("-inf")) > started.get(character_id, float("inf"))
+
+    async def flush():
+        # Entries scored by the live feed during their refresh keep the live points and stay due
+        refreshed_entries[:] = [entry for entry in refreshed_entries if not is_stale(entry)]
+        kept = {entry.id for entry in refreshed_entries}
+        activities[:] = [activity for activity in activities if activity["entry"].id in kept]
+        if len(refreshed_entries) > 0:
+            store_refreshed_entries(refreshed_entries, activities, max_delay)
+            refreshed_entries.clear()
+            activities.clear()
+
+    async def persist(entry, user_score, recent):
+        logger.debug(f"Entry {entry.character_id} updated to {user_score} points.")
+
+        entry.points = user_score
+        if rules.season.end > datetime.utcnow():
+            activities.append(schedule_entry(entry, max_delay, recent))
+        else:
+            entry.points_expiry = datetime.utcnow() + max_delay + (datetime.utcnow() - rules.season.end)
+
+        refreshed_entries.append(entry)
+        if len(refreshed_entries) >= persist_batch_size:
+            await flush()
+
+    return Pipeline([
+        Stage("discover", discover, workers=2, queue_size=4, errors=refresh_errors),
+        Stage("fetch", fetch, workers=8, queue_size=8, errors=refresh_errors),
+        Stage("score", score, workers=4, queue_size=8, errors=refresh_errors),
+        Stage("persist", persist, workers=1, queue_size=16, errors=refresh_errors, flush=flush),
+    ])
+
+
+def refresh_stats():
+    """Stats of the refresh loop and the stages of its last pipeline"""
+    stats = {"loop": dict(refresh_loop_stats)}
+    if refresh_pipeline is not None:
+        stats.update(refresh_pipeline.stats())
+    return stats
+
+
+async def refresh_entries_now(session, rules, max_delay, entries):
+    """Run the given entries through a refresh pipeline"""
+    global refresh_pipeline
+    entries = list(entries)
+    linked_characters.update(int(entry.character_id) for entry in rules.season.entries)
+
+    covered, affiliations = await discover_groups(session, rules, entries)
+    refresh_pipeline = build_refresh_pipeline(session, rules, max_delay, covered, affiliations)
+    await refresh_pipeline.run([(entry,) for entry in entries])
 
 
 @tasks.loop()
-async def refresh_scores(rules, max_delay):
+async def refresh_scores(rules, max_delay, session):
     """Background task to refresh all user scores periodically."""
 
     while True:
-        refresh_window = datetime.utcnow() + max_delay / 2
+        # Entries are refreshed in order of their next refresh, which depends on their activity
+        refresh_window = datetime.utcnow() + refresh_ahead
 
-        refresh_entries = rules.season.entries.filter(Entry.points_expiry < refresh_window)
+        refresh_entries = rules.season.entries.filter(Entry.points_expiry < refresh_window).order_by(
+            Entry.points_expiry)
 
         logger.info(f"Updating {refresh_entries.count()} entries.")
 
-        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-            try:
-                await rules.update(session)
-            except HTTPException:
-                await asyncio.sleep(60)
-                continue
-
-            for entry in refresh_entries:
-                try:
-                    score_groups, _ = await asyncio.gather(
-                        get_collated_scores(session, rules, int(entry.character_id)),
-                        asyncio.sleep(2))
-                    user_score = get_total_score(score_groups)
-                except (ValueError, AttributeError, TimeoutError, aiohttp.http_exceptions.BadHttpMessage):  # noqa
-                    await asyncio.sleep(2)  # Make sure zkill rate limit is not hit because of the error
-                    logger.warning(f"Updating character {entry.character_id} failed, skipping.", exc_info=True)
-                    continue
-                else:
-                    logger.debug(f"Entry {entry.character_id} updated to {user_score} points.")
-
-                    if rules.season.end > datetime.utcnow():
-                        entry.points_expiry = datetime.utcnow() + max_delay
-                    else:
-                        entry.points_expiry = datetime.utcnow() + max_delay + (datetime.utcnow() - rules.season.end)
-
-                    entry.points = user_score
-                    entry.save()
-                    await asyncio.sleep(2)
+        try:
+            await rules.update(session)
+        except HTTPException:
+            await asyncio.sleep(60)
+            continue
+
+        prune_kill_scores(rules)
+
+        start = time.monotonic()
+        refresh_entries = list(refresh_entries)
+        refresh_loop_stats["entries"] = len(refresh_entries)
+        await refresh_entries_now(session, rules, max_delay, refresh_entries)
+        refresh_loop_stats["runs"] += 1
+        refresh_loop_stats["last_duration"] = round(time.monotonic() - start, 1)
+
+        # Entries that failed keep their expiry and wait for the next regular check instead of being retried right away
+        failed = Entry.id.in_([entry.id for entry in refresh_entries]) & (Entry.points_expiry < datetime.utcnow())
+        refresh_loop_stats["failed"] = rules.season.entries.where(failed).count()
 
+        # Sleep until the next entry is due, but check at least every max_delay / 12
         next_refresh_time = datetime.utcnow() + max_delay / 12
-        await asyncio.sleep(max((next_refresh_time - datetime.utcnow()).total_seconds(), 0))
+        next_entry = rules.season.entries.where(~failed).order_by(Entry.points_expiry).first()
+        if next_entry is not None:
+            next_refresh_time = min(next_refresh_time, next_entry.points_expiry - refresh_ahead)
+        await asyncio.sleep(max((next_refresh_time - datetime.utcnow()).total_seconds(), min_sleep))
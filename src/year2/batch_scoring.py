@@ -0,0 +1,230 @@
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from network import get_item_types
+from points import get_fitted_items, average_meta_level, meta_level_factor, score_cache, score_cache_key, \
+    store_kill_scores
+
+# Configure the logger
+logger = logging.getLogger('discord.batch_scoring')
+logger.setLevel(logging.ERROR)
+
+# Kills are scored in chunks of similar attacker counts, to keep the padded attacker matrices small
+chunk_size = 512
+
+# Same rules as points.kill_is_valid
+invalid_systems = [30000142, 30002187, 30002510, 30002053, 30002659, 30002768, 30100000]
+concord_ship_type = 3885
+
+# Same meta-parameters as points.stapling_time
+base_time = 60
+scaling_time = 60
+attacker_scaling = 1.6
+
+
+class DenseColumn:
+    """
+    A PointColumn as dense arrays indexed by type_id, covering the types of one batch.
+    Looking up types records missing ones just like PointColumn.__call__ does.
+    """
+
+    def __init__(self, column, size):
+        self.column = column
+        self.values = np.zeros(size)
+        self.known = np.zeros(size, dtype=bool)
+        for type_id, value in column.values.items():
+            if 0 <= type_id < size:
+                self.values[type_id] = value
+                self.known[type_id] = True
+
+    def record(self, type_ids):
+        """Note every looked up type that has no value, to be written back to the spreadsheet"""
+        for type_id in np.unique(type_ids[~self.known[type_ids]]).tolist():
+            if type_id not in self.column.unknown_values:
+                self.column.missing.add(type_id)
+
+
+def powers(column, type_ids, exponent):
+    """
+    Values of a column raised to some exponent for the given types, with a mask of which worked.
+    Done per type with python floats, so results are bit for bit the same as in points.py.
+    """
+    values = np.zeros(column.values.shape)
+    ok = np.zeros(column.values.shape, dtype=bool)
+    for type_id in np.unique(type_ids).tolist():
+        if column.known[type_id]:
+            value = float(column.values[type_id]) ** exponent
+            if isinstance(value, float):
+                values[type_id] = value
+                ok[type_id] = True
+    return values, ok
+
+
+def row_sums(values, mask):
+    """Sum of each row over the masked values, added strictly in order like the builtin sum"""
+    if values.shape[1] == 0:
+        return np.zeros(values.shape[0])
+    return np.add.accumulate(np.where(mask, values, 0.0), axis=1)[:, -1]
+
+
+def attacker_matrices(kills, main_character_id):
+    """Attackers of the given kills as padded (kills x attackers) matrices"""
+    width = max([len(kill.get("attackers", [])) for kill in kills] + [0])
+    types = np.zeros((len(kills), width), dtype=np.int64)
+    present = np.zeros((len(kills), width), dtype=bool)
+    characters = np.zeros((len(kills), width), dtype=bool)
+    ships = np.zeros((len(kills), width), dtype=bool)
+    mains = np.zeros((len(kills), width), dtype=bool)
+
+    for row, kill in enumerate(kills):
+        for col, attacker in enumerate(kill.get("attackers", [])):
+            types[row, col] = attacker.get("ship_type_id", 0)
+            present[row, col] = True
+            ships[row, col] = "ship_type_id" in attacker
+            if "character_id" in attacker:
+                characters[row, col] = True
+                mains[row, col] = main_character_id is not None and int(attacker["character_id"]) == main_character_id
+
+    return types, present, characters, ships, mains
+
+
+def score_chunk(kills, rules, columns, base_powers, main_character_id):
+    """Points before meta scaling and stapling time brackets of some kills, as arrays"""
+    base, rarity_adjusted, risk_adjusted, time_adjusted = columns
+    base_pow, base_pow_ok = base_powers
+
+    victim_types = np.array([kill.get("victim", {}).get("ship_type_id", 0) for kill in kills], dtype=np.int64)
+    systems = np.array([kill.get("solar_system_id", 0) for kill in kills], dtype=np.int64)
+    kill_times = [datetime.strptime(kill['killmail_time'], '%Y-%m-%dT%H:%M:%SZ') for kill in kills]
+    types, present, characters, ships, mains = attacker_matrices(kills, main_character_id)
+
+    # STAPLING TIME
+    time_adjusted.record(victim_types)
+    base.record(types[characters])
+    attacker_sums = row_sums(base_pow[types], characters)
+    attacker_adjusted_points = np.array([s ** (1 / attacker_scaling) for s in attacker_sums.tolist()])
+
+    time_error = ~time_adjusted.known[victim_types] | (characters & ~base_pow_ok[types]).any(axis=1)
+    time_error |= attacker_adjusted_points == 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        seconds = base_time + scaling_time * time_adjusted.values[victim_types] / attacker_adjusted_points
+    seconds = np.where(time_error, base_time + scaling_time, seconds)
+
+    # VALIDITY
+    in_season = np.array([rules.season.start < kill_time < rules.season.end for kill_time in kill_times])
+    valid = ~np.isin(systems, invalid_systems) & ~(present & (types == concord_ship_type)).any(axis=1)
+    active = in_season & valid
+
+    # ATTACKERS / VICTIM CALCULATION
+    rarity_adjusted.record(victim_types[active])
+    rarity_adjusted_victim_points = rarity_adjusted.values[victim_types]
+    error = ~rarity_adjusted.known[victim_types]
+
+    if main_character_id is not None:
+        # The protagonist must fly some ship, if they appear multiple times the last one counts
+        others = characters & ~mains
+        pilots = characters & mains & ships
+        risk_adjusted.record(types[pilots & active[:, None]])
+
+        last_pilot = pilots.shape[1] - 1 - np.argmax(pilots[:, ::-1], axis=1) if pilots.shape[1] > 0 \
+            else np.zeros(len(kills), dtype=np.int64)
+        pilot_types = types[np.arange(len(kills)), last_pilot] if pilots.shape[1] > 0 \
+            else np.zeros(len(kills), dtype=np.int64)
+        has_pilot = pilots.any(axis=1)
+
+        risk_adjusted_pilot_points = np.where(has_pilot, risk_adjusted.values[pilot_types], 0.0)
+        error |= ~has_pilot | ~risk_adjusted.known[pilot_types]
+    else:
+        # Without a protagonist, use the smallest risk adjusted difference of any attacker
+        others = characters
+        risk_adjusted.record(types[characters & active[:, None]])
+
+        standard = base.values[types]
+        risk = risk_adjusted.values[types]
+        usable = characters & base.known[types] & risk_adjusted.known[types] & (standard != 0) & (risk != 0)
+        differences = np.where(usable, risk - standard, np.inf)
+        risk_adjusted_pilot_points = np.minimum(0.0, differences.min(axis=1)) if differences.shape[1] > 0 \
+            else np.zeros(len(kills))
+
+    base.record(types[others & active[:, None]])
+    error |= (others & ~base.known[types]).any(axis=1)
+    standard_sums = row_sums(base.values[types], others)
+
+    # Combine points into preliminary score
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = risk_adjusted_pilot_points + standard_sums
+        kill_scores = 10 * rarity_adjusted_victim_points / denominator
+    kill_scores = np.where(error | (denominator == 0), 0.0, kill_scores)
+
+    return kill_times, active, kill_scores, seconds
+
+
+async def get_kill_scores_batch(session, rules, kills, main_character_id=None):
+    """
+    Score many killmails at once, giving the same results as points.get_kill_score for each of them.
+    Kills are given as a dict of kill_id to killmail.
+
+    Point tables are turned into dense arrays by type_id, so victim points, attacker sums, risk adjustment and
+    stapling brackets are array operations. Powers and exponentials stay per type / per kill python math,
+    so results match exactly.
+    """
+    kill_ids = list(kills.keys())
+    killmails = [kills[kill_id] for kill_id in kill_ids]
+    if len(killmails) == 0:
+        return []
+
+    # Dense point tables for all types that can be looked up in this batch
+    all_types = [kill.get("victim", {}).get("ship_type_id", 0) for kill in killmails]
+    all_types += [attacker.get("ship_type_id", 0) for kill in killmails for attacker in kill.get("attackers", [])]
+    size = max(all_types) + 1
+    columns = [DenseColumn(column, size) for column in
+               (rules.base, rules.rarity_adjusted, rules.risk_adjusted, rules.time_adjusted)]
+    base_powers = powers(columns[0], np.array(all_types, dtype=np.int64), attacker_scaling)
+
+    kill_times = [None] * len(killmails)
+    active = np.zeros(len(killmails), dtype=bool)
+    kill_scores = np.zeros(len(killmails))
+    seconds = np.zeros(len(killmails))
+
+    # Similar attacker counts in each chunk keep the padding small
+    order = sorted(range(len(killmails)), key=lambda i: len(killmails[i].get("attackers", [])))
+    for start in range(0, len(order), chunk_size):
+        indices = order[start:start + chunk_size]
+        chunk_times, chunk_active, chunk_scores, chunk_seconds = score_chunk(
+            [killmails[i] for i in indices], rules, columns, base_powers, main_character_id)
+        for i, kill_time in zip(indices, chunk_times):
+            kill_times[i] = kill_time
+        active[indices] = chunk_active
+        kill_scores[indices] = chunk_scores
+        seconds[indices] = chunk_seconds
+
+    # Meta level scaling, with all types of all scored kills looked up at once
+    scaled = np.flatnonzero(active & (kill_scores != 0))
+    type_ids = set()
+    for i in scaled.tolist():
+        type_ids.add(killmails[i]["victim"]["ship_type_id"])
+        type_ids.update(type_id for _, type_id in get_fitted_items(killmails[i]))
+    item_types = await get_item_types(session, type_ids)
+
+    factors = np.ones(len(killmails))
+    factors[scaled] = [meta_level_factor(average_meta_level(killmails[i], item_types)) for i in scaled.tolist()]
+    kill_scores = kill_scores * factors
+
+    results = []
+    for i, kill_id in enumerate(kill_ids):
+        time_bracket = timedelta(seconds=float(seconds[i]))
+        kill_score = float(kill_scores[i]) if active[i] else 0
+        results.append((kill_id, kill_times[i], kill_score, time_bracket))
+
+    return results
+
+
+async def score_kills_batch(session, rules, character_id, kill_data):
+    """Score fetched killmails of a character in one batch and put them into the score cache and store"""
+    results = await get_kill_scores_batch(session, rules, kill_data, character_id)
+    for result in results:
+        score_cache.set(score_cache_key(rules, result[0], character_id), result)
+    store_kill_scores(rules, character_id, results)
+    return results
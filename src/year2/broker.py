@@ -0,0 +1,173 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from urllib.parse import urlparse
+
+from metrics import http_requests, http_latency
+
+# Configure the logger
+logger = logging.getLogger('discord.broker')
+logger.setLevel(logging.WARNING)
+
+# Lower numbers are served first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Priority of requests made from the current task, commands switch this to INTERACTIVE
+request_priority = contextvars.ContextVar("request_priority", default=BACKGROUND)
+
+# Keeps requests of the same priority in order
+counter = itertools.count()
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts up to burst requests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self):
+        """Seconds until the next token is available"""
+        self.refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.refill()
+        self.tokens -= 1
+
+
+class HostLimiter:
+    """
+    Rate limit for a single host. Requests wait in a priority queue until
+    a token is available, the host is not paused and there is a free connection slot.
+    The rate is halved on each 429 and slowly recovers with successful requests.
+    """
+
+    def __init__(self, host, rate, burst, concurrency):
+        self.host = host
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.active = 0
+        self.paused_until = 0.0
+        self.waiting = []
+        self.condition = asyncio.Condition()
+
+    def delay(self):
+        return max(self.bucket.delay(), self.paused_until - time.monotonic())
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def slow_down(self):
+        self.bucket.rate = max(self.max_rate / 16, self.bucket.rate / 2)
+
+    def speed_up(self):
+        self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 100)
+
+    async def acquire(self, priority):
+        entry = (priority, next(counter))
+        heapq.heappush(self.waiting, entry)
+
+        async with self.condition:
+            try:
+                while True:
+                    delay = self.delay()
+                    if self.waiting[0] == entry and delay <= 0 and self.active < self.concurrency:
+                        heapq.heappop(self.waiting)
+                        self.bucket.take()
+                        self.active += 1
+                        self.condition.notify_all()
+                        return
+
+                    try:
+                        await asyncio.wait_for(self.condition.wait(), timeout=delay if delay > 0 else None)
+                    except asyncio.TimeoutError:
+                        pass
+            except BaseException:
+                if entry in self.waiting:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                self.condition.notify_all()
+                raise
+
+    async def release(self):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+
+class RequestBroker:
+    """Every outbound request goes through here to be limited per host"""
+
+    def __init__(self, limits, default_limit):
+        self.limits = limits
+        self.default_limit = default_limit
+        self.hosts = {}
+
+    def limiter(self, host):
+        if host not in self.hosts:
+            rate, burst, concurrency = self.limits.get(host, self.default_limit)
+            self.hosts[host] = HostLimiter(host, rate, burst, concurrency)
+        return self.hosts[host]
+
+    def feedback(self, limiter, response):
+        """Adapt the limits of a host to the response"""
+        if response.status == 429:
+            retry_after = float(response.headers.get("Retry-After", 2))
+            logger.warning(f"Too many requests to {limiter.host}, pausing for {retry_after}s.")
+            limiter.slow_down()
+            limiter.pause(retry_after)
+        else:
+            limiter.speed_up()
+
+        # ESI blocks clients that run out of errors, stop before that happens
+        if "X-Esi-Error-Limit-Remain" in response.headers:
+            remain = int(response.headers["X-Esi-Error-Limit-Remain"])
+            reset = int(response.headers.get("X-Esi-Error-Limit-Reset", 0))
+            if remain < 10:
+                logger.warning(f"ESI error limit at {remain}, pausing for {reset}s.")
+                limiter.pause(reset)
+
+    @contextlib.asynccontextmanager
+    async def request(self, session, method, url, **kwargs):
+        """Make a request with the session once the host allows it"""
+        limiter = self.limiter(urlparse(url).hostname)
+        await limiter.acquire(request_priority.get())
+        try:
+            start = time.monotonic()
+            async with session.request(method, url, **kwargs) as response:
+                http_requests.inc(limiter.host, response.status)
+                http_latency.observe(time.monotonic() - start, limiter.host)
+                self.feedback(limiter, response)
+                yield response
+        finally:
+            await limiter.release()
+
+    def stats(self):
+        return {host: {"rate": round(limiter.bucket.rate, 2), "active": limiter.active,
+                       "waiting": len(limiter.waiting),
+                       "paused": round(max(0.0, limiter.paused_until - time.monotonic()), 1)}
+                for host, limiter in self.hosts.items()}
+
+
+# (requests per second, burst, concurrent requests) per host
+broker = RequestBroker(
+    limits={
+        "esi.evetech.net": (50, 50, 50),
+        "zkillboard.com": (1, 2, 2),
+    },
+    default_limit=(10, 10, 10),
+)
@@ -0,0 +1,113 @@
+import asyncio
+import functools
+import time
+from collections import OrderedDict
+
+# All caches of the process by name, to be able to inspect them
+caches = {}
+
+
+class Cache:
+    """LRU cache with an optional time to live, shared by the whole process"""
+
+    def __init__(self, name, maxsize, ttl=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        caches[name] = self
+
+    def __contains__(self, key):
+        """Check for a valid value without touching stats or order"""
+        try:
+            expiry, _ = self.data[key]
+        except KeyError:
+            return False
+        return expiry is None or expiry >= time.monotonic()
+
+    def get(self, key):
+        """Returns a tuple of (found, value)"""
+        try:
+            expiry, value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+
+        if expiry is not None and expiry < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return False, None
+
+        self.data.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def set(self, key, value):
+        expiry = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.data[key] = (expiry, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total > 0 else 0.0,
+        }
+
+
+def cache_stats():
+    """Stats of every cache in the process"""
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+def cached(name, maxsize, ttl=None, key=None):
+    """
+    Decorator for async network functions that take a session as their first argument.
+    Only the remaining arguments are used as cache key, so results are shared between sessions.
+    A key function can build the cache key from those arguments instead.
+    Concurrent calls with the same key wait for the same request.
+    """
+
+    def decorator(func):
+        cache = Cache(name, maxsize, ttl)
+        pending = {}
+
+        def done(cache_key, task):
+            pending.pop(cache_key, None)
+            if not task.cancelled() and task.exception() is None:
+                cache.set(cache_key, task.result())
+
+        @functools.wraps(func)
+        async def wrapper(session, *args, **kwargs):
+            cache_key = key(*args, **kwargs) if key is not None else args + tuple(sorted(kwargs.items()))
+            found, value = cache.get(cache_key)
+            if found:
+                return value
+
+            task = pending.get(cache_key)
+            if task is None:
+                task = asyncio.ensure_future(func(session, *args, **kwargs))
+                pending[cache_key] = task
+                task.add_done_callback(functools.partial(done, cache_key))
+
+            return await asyncio.shield(task)
+
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator
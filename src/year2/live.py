@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+import aiohttp
+from discord.ext import tasks
+
+from background import refresh_errors, live_updates
+from batch_scoring import score_kills_batch
+from broker import broker
+from models import Entry, KillCursor
+from network import generate_headers, get, store_kill, participants, known_kills
+from points import get_total_score, get_kill_scores, get_unscored_kills, collate_character_scores
+
+# Configure the logger
+logger = logging.getLogger('discord.live')
+logger.setLevel(logging.INFO)
+
+# Killmail feed in the format of zkillboard's RedisQ, can point to a local stand-in instead
+redisq_url = os.environ.get("REDISQ_URL", "https://zkillredisq.stream/listen.php")
+
+# Stats of the live feed
+live_stats = {"received": 0, "matched": 0, "scored": 0, "errors": 0}
+
+
+async def listen(session, queue_id):
+    """Wait for the next killmail of the feed, returns the RedisQ package or None if there was no new kill"""
+    url = f"{redisq_url}?queueID={queue_id}&ttw=10"
+    async with broker.request(session, "GET", url, headers=generate_headers(url)) as response:
+        if response.status != 200:
+            raise ValueError(f"Could not listen to the killmail feed: {response.status}")
+        return (await response.json(content_type=None)).get("package")
+
+
+async def rescore_entry(session, rules, entry):
+    """Recalculate the points of an entry from its known kills, without crawling zkillboard"""
+    character_id = int(entry.character_id)
+    cursor = KillCursor.get_or_none(KillCursor.character_id == character_id)
+    kills = known_kills(character_id, cursor.oldest_kill_id if cursor is not None else 0)
+
+    kill_data = await get_unscored_kills(session, rules, character_id, kills)
+    await score_kills_batch(session, rules, character_id, kill_data)
+    kill_scores = await get_kill_scores(session, rules, character_id, kills, {})
+    return get_total_score(collate_character_scores(rules, character_id, kill_scores))
+
+
+async def ingest_kill(session, rules, package):
+    """Store a killmail from the feed and update the points of all linked characters on it right away"""
+    kill_id = int(package["killID"])
+    kill_hash = package["zkb"]["hash"]
+
+    # Older feeds send the whole killmail, newer ones only id and hash
+    kill = package.get("killmail")
+    if kill is None:
+        kill = await get(session, f"https://esi.evetech.net/latest/killmails/{kill_id}/{kill_hash}/")
+    live_stats["received"] += 1
+
+    character_ids = participants(kill)
+    if len(character_ids) == 0:
+        return
+    live_stats["matched"] += 1
+
+    # Only kills of linked characters are kept, storing the killmail credits it to every linked character on it
+    store_kill(kill_id, kill_hash, kill)
+
+    # Entries that were never refreshed are left to polling, their kills are not known yet
+    entries = rules.season.entries.where(Entry.character_id.in_([str(c) for c in character_ids]) &
+                                         (Entry.points_expiry > datetime.utcnow()))
+    for entry in entries:
+        # The expiry is kept, so polling still reconciles kills the feed missed
+        # Only the points are written, so the refresh schedule of the entry is left alone
+        entry.points = await rescore_entry(session, rules, entry)
+        Entry.update(points=entry.points).where(Entry.id == entry.id).execute()
+        live_updates[int(entry.character_id)] = time.monotonic()
+        live_stats["scored"] += 1
+        logger.info(f"Kill {kill_id} updated entry {entry.character_id} to {entry.points} points.")
+
+
+@tasks.loop()
+async def ingest_live_kills(rules, session, queue_id):
+    """Background task to score kills as soon as they show up in the killmail feed."""
+
+    while True:
+        try:
+            package = await listen(session, queue_id)
+            if package is not None:
+                await ingest_kill(session, rules, package)
+        except refresh_errors + (KeyError, asyncio.TimeoutError, aiohttp.ClientError):
+            live_stats["errors"] += 1
+            logger.warning("Could not ingest from the killmail feed.", exc_info=True)
+            await asyncio.sleep(5)
@@ -2,19 +2,23 @@ import asyncio
 import functools
 import logging
 import os
-import ssl
 from datetime import datetime, timedelta
 
-import aiohttp
-import certifi
 import discord
 from discord.ext import commands
 
-from background import refresh_scores
+from admission import admission, command_cost, Rejected
+from background import refresh_scores, refresh_entries_now, refresh_stats
+from broker import broker, request_priority, INTERACTIVE, BACKGROUND
+from cache import cache_stats
+from live import ingest_live_kills, live_stats
+from metrics import register_section, start_server as start_metrics_server, summary
 from models import initialize_database, User, Season, Entry
-from network import lookup, get_hash, get_character_name
-from points import get_total_score, get_collated_scores, get_kill_score
+from network import create_session, lookup, get_hash, get_names, index_kill_types, linked_characters, \
+    killmail_store_stats
+from points import get_total_score, get_collated_scores, get_kill_score, get_stored_score_groups, apply_rule_change
 from rules import RulesConnector
+from scheduling import record_query
 from utils import send_large_message
 
 # Configure the logger
@@ -26,7 +30,29 @@ intent = discord.Intents.default()
 intent.messages = True
 intent.message_content = True
 client = discord.Client(intents=intent)
-bot = commands.Bot(command_prefix='!', intents=intent)
+
+
+class MetashiftBot(commands.Bot):
+    """Bot owning the pooled session used for all outbound requests"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self.metrics_runner = None
+
+    async def setup_hook(self):
+        self.session = create_session()
+        self.metrics_runner = await start_metrics_server(int(os.environ.get("METRICS_PORT", 9108)))
+
+    async def close(self):
+        await super().close()
+        if self.session is not None:
+            await self.session.close()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+
+
+bot = MetashiftBot(command_prefix='!', intents=intent)
 
 # Initialize Database
 initialize_database()
@@ -34,52 +60,100 @@ initialize_database()
 # Get the newest season that already started
 current_season = Season.select().where(Season.start <= datetime.utcnow()).order_by(Season.start.desc()).get()
 rules = RulesConnector(current_season)
-
-# Adding ssl context because aiohttp doesn't come with certificates
-ssl_context = ssl.create_default_context(cafile=certifi.where())
+rules.listeners.append(apply_rule_change)
+index_kill_types()
+linked_characters.update(int(entry.character_id) for entry in current_season.entries)
 
 # Setup constants
-max_delay = timedelta(hours=1)
+# With the live killmail feed, polling only has to catch the kills the feed missed
+live_queue_id = os.environ.get("REDISQ_QUEUE_ID")
+max_delay = timedelta(hours=6) if live_queue_id else timedelta(hours=1)
+
+
+def entry_stats():
+    """How far behind the refresh of the entries is"""
+    now = datetime.utcnow()
+    stale_entries = current_season.entries.where(Entry.points_expiry < now)
+    oldest = stale_entries.order_by(Entry.points_expiry).first()
+    return {"total": current_season.entries.count(), "stale": stale_entries.count(),
+            "lag_seconds": round((now - oldest.points_expiry).total_seconds(), 1) if oldest is not None else 0.0}
+
+
+register_section("caches", cache_stats)
+register_section("hosts", broker.stats)
+register_section("killmail_store", lambda: killmail_store_stats)
+register_section("refresh", refresh_stats)
+register_section("entries", entry_stats)
+register_section("live", lambda: live_stats)
+register_section("admission", admission.stats)
+
 
+# Longest time a command waits for expired scores before answering with the last known ones, in seconds
+refresh_deadline = 5
 
-async def update_scores_now(ctx, session, rules):
+# Attempts to refresh failing entries before leaving them to the background refresh
+refresh_attempts = 3
+
+# Refresh of expired entries started by a command, shared by all commands
+revalidation = None
+
+
+async def update_scores_now(session, rules):
+    # Refreshes run in their own task, so they do not take the priority of the command that started them
+    request_priority.set(BACKGROUND)
     await rules.update(session)
 
     # Query the database to find entries with expired points
     expired_entries = rules.season.entries.filter(Entry.points_expiry < datetime.utcnow())
 
-    # If there are more than 3 expired entries, send a message to ctx
-    if expired_entries.count() > 3:
-        await ctx.send("Refreshing some scores, this might take a bit...")
+    for attempt in range(refresh_attempts):
+        if expired_entries.count() == 0:
+            break
 
-    while expired_entries.count() > 0:
-        for entry in expired_entries:
-            try:
-                score_groups, _ = await asyncio.gather(
-                    get_collated_scores(session, rules, int(entry.character_id)),
-                    asyncio.sleep(1)
-                )
-                user_score = get_total_score(score_groups)
-            except (ValueError, AttributeError, TimeoutError, aiohttp.http_exceptions.BadHttpMessage):  # noqa
-                await asyncio.sleep(1)  # Make sure zkill rate limit is not hit because of the error
-                logger.warning(f"Updating character {entry.character_id} failed, retrying.")
-            else:
-                logger.debug(f"Character {entry.character_id} scored {user_score} points")
-                entry.points_expiry = datetime.utcnow() + max_delay
-                entry.points = user_score
-                entry.save()
-
-        # Update expired entries
+        await refresh_entries_now(session, rules, max_delay, expired_entries)
+
+        # Update expired entries, failed ones are retried
         expired_entries = rules.season.entries.filter(Entry.points_expiry < datetime.utcnow())
+        if expired_entries.count() > 0:
+            logger.warning(f"Updating {expired_entries.count()} entries failed, retrying.")
+
+
+async def revalidate_scores(ctx, session, rules):
+    """
+    Refresh expired entries in the background, commands wait for it at most refresh_deadline seconds.
+    The stored points of the entries are the leaderboard, so commands can always answer from them.
+    """
+    global revalidation
+    if revalidation is None or revalidation.done():
+        revalidation = asyncio.create_task(update_scores_now(session, rules))
+        revalidation.add_done_callback(log_revalidation)
+
+    try:
+        await asyncio.wait_for(asyncio.shield(revalidation), timeout=refresh_deadline)
+    except asyncio.TimeoutError:
+        await ctx.send("Some scores are still refreshing, showing the last known ones (marked with *).")
+    except Exception:
+        pass  # Logged once by log_revalidation, the command answers from the stored points
+
+
+def log_revalidation(task):
+    """Retrieve the outcome of a revalidation, also when no command waited for it"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Could not refresh scores.", exc_info=task.exception())
+
+
+def stale_marker(entry):
+    """Marks entries whose points are older than they should be"""
+    return "*" if entry.points_expiry < datetime.utcnow() else ""
 
 
-async def find_character_id(author_id: str, character_name_array: tuple):
+async def find_character_id(session, author_id: str, character_name_array: tuple):
     """Given a Discord ID and an input character, find a suitable character ID and possessive form.
     prefer the name given before fetching one via the discord user"""
     if len(character_name_array) > 0:
         character_name = " ".join(character_name_array)
         try:
-            character_id = await lookup(character_name, 'characters')
+            character_id = await lookup(session, character_name, 'characters')
         except ValueError:
             raise ValueError("Could not resolve that character!")
         possesive = f"[{character_name}](https://zkillboard.com/character/{character_id}/) currently has"
@@ -117,8 +191,15 @@ def command_error_handler(func):
         ctx = args[0]
         logger.info(f"{ctx.author.name} used !{func.__name__}")
 
+        # Requests made for commands are served before the ones of the background refresh
+        request_priority.set(INTERACTIVE)
+
         try:
-            return await func(*args, **kwargs)
+            async with admission.admit(ctx, command_cost(func.__name__, args[1:])):
+                return await func(*args, **kwargs)
+        except Rejected as e:
+            logger.info(f"Turned away !{func.__name__} of {ctx.author.name}: {e}")
+            await ctx.send(str(e))
         except Exception as e:
             logger.error(f"Error in !{func.__name__} command: {e}", exc_info=True)
             await ctx.send(f"An error occurred in !{func.__name__}.")
@@ -129,7 +210,10 @@ def command_error_handler(func):
 @bot.event
 async def on_ready():
     logger.info(f"Metashiftbot ready with {current_season}.")
-    refresh_scores.start(rules, max_delay)
+    if not refresh_scores.is_running():
+        refresh_scores.start(rules, max_delay, bot.session)
+    if live_queue_id and not ingest_live_kills.is_running():
+        ingest_live_kills.start(rules, bot.session, live_queue_id)
 
 
 @bot.command()
@@ -140,7 +224,7 @@ async def link(ctx, *character_name):
     # Figure out the character
     character_name = " ".join(character_name)
     try:
-        character_id = await lookup(character_name, 'characters')
+        character_id = await lookup(bot.session, character_name, 'characters')
     except ValueError:
         await ctx.send(f"Could not resolve that character!")
         return
@@ -153,12 +237,14 @@ async def link(ctx, *character_name):
     )
 
     if created:
+        linked_characters.add(int(character_id))
         await ctx.send(f"Linked [{character_name}](https://zkillboard.com/character/{character_id}/)")
     else:
         if entry.relinks > 0 or str(ctx.author.ids) in os.environ["PRIVILEGED_USERS"].split(" "):
             entry.relinks -= 1
             entry.character_id = character_id
             entry.save()
+            linked_characters.add(int(character_id))
             await ctx.send(f"Updated your linked character to "
                            f"[{character_name}](https://zkillboard.com/character/{character_id}/) "
                            f"({entry.relinks} uses remaining)")
@@ -188,32 +274,36 @@ async def unlink(ctx):
 async def leaderboard(ctx, top=None):
     """Shows the current people with the most points."""
 
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
+    session = bot.session
 
-        # Ensure all data is up-to-date
-        await update_scores_now(ctx, session, rules)
+    # Refresh outdated data, without waiting for it too long
+    await revalidate_scores(ctx, session, rules)
 
-        # Parse length of data to show
-        if top is None:
-            top = 10
-        elif top in ["all", "csv"] and str(ctx.author.id) in os.environ["PRIVILEGED_USERS"].split(" "):
-            top = current_season.entries.count()
+    # Parse length of data to show
+    if top is None:
+        top = 10
+    elif top in ["all", "csv"] and str(ctx.author.id) in os.environ["PRIVILEGED_USERS"].split(" "):
+        top = current_season.entries.count()
 
-        # Build output
-        output = "# Leaderboard\n"
-        for count, entry in enumerate(current_season.entries.order_by(Entry.points.desc()).limit(top)):
-            if top == "csv":
-                output += (
-                    f"{count + 1}, {(bot.get_user(entry.user.user_id)).name}, "
-                    f"{await get_character_name(session, entry.character_id)}, {entry.points:.1f}"
-                )
-            else:
-                output += (
-                    f"{count + 1}: <@{entry.user.user_id}> [{await get_character_name(session, entry.character_id)}]"
-                    f"(<https://zkillboard.com/character/{entry.character_id}/>) with {entry.points:.1f} points\n"
-                )
+    # Build output
+    output = "# Leaderboard\n"
+    entries = list(current_season.entries.select(Entry, User).join(User).order_by(Entry.points.desc(), Entry.id)
+                   .limit(top))
+    names = await get_names(session, [entry.character_id for entry in entries])
+    for count, entry in enumerate(entries):
+        if top == "csv":
+            output += (
+                f"{count + 1}, {(bot.get_user(entry.user.user_id)).name}, "
+                f"{names[int(entry.character_id)]}, {entry.points:.1f}"
+            )
+        else:
+            output += (
+                f"{count + 1}: <@{entry.user.user_id}> [{names[int(entry.character_id)]}]"
+                f"(<https://zkillboard.com/character/{entry.character_id}/>) with {entry.points:.1f} points"
+                f"{stale_marker(entry)}\n"
+            )
 
-        await send_large_message(ctx, output, delimiter="\n", allowed_mentions=discord.AllowedMentions(users=False))
+    await send_large_message(ctx, output, delimiter="\n", allowed_mentions=discord.AllowedMentions(users=False))
 
 
 @bot.command()
@@ -221,36 +311,38 @@ async def leaderboard(ctx, top=None):
 async def ranking(ctx):
     """Shows the people around your current score."""
 
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
+    session = bot.session
 
-        # Ensure all data is up-to-date
-        await update_scores_now(ctx, session, rules)
+    # Refresh outdated data, without waiting for it too long
+    await revalidate_scores(ctx, session, rules)
 
-        # Fetch user scores from the database
-        user_entries = current_season.entries.order_by(Entry.points.desc())
-        users_leaderboard = [(entry.user.user_id, entry.character_id, entry.points) for entry in user_entries]
-        author_ids = [entry[0] for entry in users_leaderboard]
+    # Find the entry of the author and its position, ties are ordered by entry
+    entry = current_season.entries.join(User).where(User.user_id == str(ctx.author.id)).first()
+    if entry is None:
+        await ctx.send(f"You do not have any linked character!")
+        return
 
-        # Calculate which entries to show
-        try:
-            middle = author_ids.index(str(ctx.author.id))
-            first = max(middle - 2, 0)
-            last = min(middle + 3, len(users_leaderboard))
-        except ValueError:
-            await ctx.send(f"You do not have any linked character!")
-            return
+    middle = current_season.entries.where(
+        (Entry.points > entry.points) | ((Entry.points == entry.points) & (Entry.id < entry.id))).count()
+    first = max(middle - 2, 0)
 
-        # Build output
-        output = "# Leaderboard\n (around your position)\n"
-        count = first + 1
-        for aid, cid, score in users_leaderboard[first:last]:
-            output += (
-                f"{count}: <@{aid}> [{await get_character_name(session, cid)}]"
-                f"(<https://zkillboard.com/character/{cid}/>) with {score:.1f} points\n"
-            )
-            count += 1
+    # Fetch only the surrounding entries, with their users
+    user_entries = list(current_season.entries.select(Entry, User).join(User)
+                        .order_by(Entry.points.desc(), Entry.id).offset(first).limit(5))
+    names = await get_names(session, [entry.character_id for entry in user_entries])
+
+    # Build output
+    output = "# Leaderboard\n (around your position)\n"
+    count = first + 1
+    for entry in user_entries:
+        output += (
+            f"{count}: <@{entry.user.user_id}> [{names[int(entry.character_id)]}]"
+            f"(<https://zkillboard.com/character/{entry.character_id}/>) with {entry.points:.1f} points"
+            f"{stale_marker(entry)}\n"
+        )
+        count += 1
 
-        await send_large_message(ctx, output, delimiter="\n", allowed_mentions=discord.AllowedMentions(users=False))
+    await send_large_message(ctx, output, delimiter="\n", allowed_mentions=discord.AllowedMentions(users=False))
 
 
 @bot.command()
@@ -260,21 +352,22 @@ async def points(ctx, *character_name):
 
     # Parse arguments and log
     try:
-        character_id, predicate = await find_character_id(str(ctx.author.id), character_name)
+        character_id, predicate = await find_character_id(bot.session, str(ctx.author.id), character_name)
     except ValueError as instance:
         await ctx.send(f"Error: {instance}.")
         return
 
     logger.info(f"{ctx.author.name} used !points {character_id}")
+    record_query(current_season, character_id, max_delay)
 
     # Execute command
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
+    session = bot.session
 
-        # Get data
-        await rules.update(session)
-        score_groups = await get_collated_scores(session, rules, character_id)
+    # Get data
+    await rules.update(session)
+    score_groups = await get_collated_scores(session, rules, character_id)
 
-        await ctx.send(f"{predicate} {get_total_score(score_groups)} points")
+    await ctx.send(f"{predicate} {get_total_score(score_groups)} points")
 
 
 @bot.command()
@@ -283,38 +376,44 @@ async def breakdown(ctx, *character_name):
     """Shows a breakdown of how someone achieved their points, defaults to your linked character."""
 
     try:
-        character_id, predicate = await find_character_id(str(ctx.author.id), character_name)
+        character_id, predicate = await find_character_id(bot.session, str(ctx.author.id), character_name)
     except ValueError as instance:
         await ctx.send(f"Error: {instance}.")
         return
     logger.info(f"{ctx.author.name} used !breakdown {character_id}")
+    record_query(current_season, character_id, max_delay)
 
     # Execute command
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
+    session = bot.session
 
-        # Get data
-        await rules.update(session)
+    # Get data, from the stored score state if the character is a fresh entry
+    await rules.update(session)
+    groups = None
+    if current_season.entries.where((Entry.character_id == str(character_id)) &
+                                    (Entry.points_expiry > datetime.utcnow())).exists():
+        groups = get_stored_score_groups(rules, character_id)
+    if groups is None:
         groups = await get_collated_scores(session, rules, character_id)
 
-        # Build output
-        output = f"{predicate} {get_total_score(groups)} points with the following distribution:\n"
-        point_strings = []
-        for total_score, kills in sorted(groups, reverse=True)[0:30]:
-            if len(kills) == 1:
-                point_string = f"[**{total_score:.1f}**](<https://zkillboard.com/kill/{kills[0][0]}/>)"
-            else:
-                point_string = f"**{total_score:.1f}** ("
-                links = [f"[{s:.1f}](<https://zkillboard.com/kill/{i}/>)" for i, s in kills]
-                point_string += ", ".join(links)
-                point_string += ")"
-            point_strings.append(point_string)
-        output += ", ".join(point_strings)
+    # Build output
+    output = f"{predicate} {get_total_score(groups)} points with the following distribution:\n"
+    point_strings = []
+    for total_score, kills in sorted(groups, reverse=True)[0:30]:
+        if len(kills) == 1:
+            point_string = f"[**{total_score:.1f}**](<https://zkillboard.com/kill/{kills[0][0]}/>)"
+        else:
+            point_string = f"**{total_score:.1f}** ("
+            links = [f"[{s:.1f}](<https://zkillboard.com/kill/{i}/>)" for i, s in kills]
+            point_string += ", ".join(links)
+            point_string += ")"
+        point_strings.append(point_string)
+    output += ", ".join(point_strings)
 
-        if len(point_strings) == 0:
-            output += "- no points for this character so far."
+    if len(point_strings) == 0:
+        output += "- no points for this character so far."
 
-        # Send message
-        await send_large_message(ctx, output, delimiter=",", allowed_mentions=discord.AllowedMentions(users=False))
+    # Send message
+    await send_large_message(ctx, output, delimiter=",", allowed_mentions=discord.AllowedMentions(users=False))
 
 
 @bot.command()
@@ -325,26 +424,37 @@ async def explain(ctx, zkill_link, *character_name):
     # Parse arguments and log
     kill_id = find_kill_id(zkill_link)
     try:
-        character_id, _ = await find_character_id(None, character_name)
+        character_id, _ = await find_character_id(bot.session, None, character_name)
     except ValueError as instance:
         await ctx.send(f"Error: {instance}.")
         return
     logger.info(f"{ctx.author.name} used !explain {kill_id} {character_id}")
 
     # Execute command
-    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-
-        await rules.update(session)
-        kill_hash = await get_hash(session, kill_id)
-        kill_id, kill_time, kill_score, time_bracket = await get_kill_score(session, kill_id, kill_hash, rules,
-                                                                            main_character_id=character_id)
-        if character_id is not None:
-            explain_style = "when using the largest ship as the ship of the contestant"
-        else:
-            explain_style = "with the given character"
+    session = bot.session
+    await rules.update(session)
+    kill_hash = await get_hash(session, kill_id)
+    kill_id, kill_time, kill_score, time_bracket = await get_kill_score(session, kill_id, kill_hash, rules,
+                                                                        main_character_id=character_id)
+    if character_id is not None:
+        explain_style = "when using the largest ship as the ship of the contestant"
+    else:
+        explain_style = "with the given character"
+
+    await ctx.channel.send(f"This [kill](https://zkillboard.com/kill/{kill_id}/) is worth {kill_score:.1f} "
+                           f"{explain_style}, and will chain for {time_bracket.total_seconds():.1f} seconds.")
+
+
+@bot.command()
+@command_error_handler
+async def stats(ctx):
+    """Shows how the bot is doing, only for privileged users."""
+
+    if str(ctx.author.id) not in os.environ["PRIVILEGED_USERS"].split(" "):
+        await ctx.send("This command is only for privileged users.")
+        return
 
-        await ctx.channel.send(f"This [kill](https://zkillboard.com/kill/{kill_id}/) is worth {kill_score:.1f} "
-                               f"{explain_style}, and will chain for {time_bracket.total_seconds():.1f} seconds.")
+    await send_large_message(ctx, summary(), delimiter="\n")
 
 
 bot.run(os.environ["TOKEN"])
@@ -0,0 +1,195 @@
+import bisect
+import contextlib
+import logging
+import re
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from aiohttp import web
+
+# Configure the logger
+logger = logging.getLogger('discord.metrics')
+logger.setLevel(logging.INFO)
+
+# Prefix of all exported metrics
+prefix = "metashift"
+
+# Functions returning the current stats of some part of the bot, by section name
+sections = {}
+
+# Counters and histograms kept by the bot
+metrics = []
+
+
+class Counter:
+    """Counts events by a tuple of label values"""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = defaultdict(float)
+        metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def lines(self):
+        yield f"# HELP {prefix}_{self.name} {self.help_text}"
+        yield f"# TYPE {prefix}_{self.name} counter"
+        for label_values, value in self.values.items():
+            yield f"{prefix}_{self.name}{format_labels(zip(self.labels, label_values))} {value}"
+
+
+class Histogram:
+    """Distribution of observed values by a tuple of label values, in buckets by upper bound"""
+
+    def __init__(self, name, help_text, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * (len(self.buckets) + 1))
+        self.sums = defaultdict(float)
+        metrics.append(self)
+
+    def observe(self, value, *label_values):
+        self.counts[label_values][bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def count(self, *label_values):
+        return sum(self.counts[label_values]) if label_values in self.counts else 0
+
+    def lines(self):
+        yield f"# HELP {prefix}_{self.name} {self.help_text}"
+        yield f"# TYPE {prefix}_{self.name} histogram"
+        for label_values, counts in list(self.counts.items()):
+            labels = list(zip(self.labels, label_values))
+            total = 0
+            for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                total += count
+                yield f"{prefix}_{self.name}_bucket{format_labels(labels + [('le', bound)])} {total}"
+            yield f"{prefix}_{self.name}_sum{format_labels(labels)} {self.sums[label_values]}"
+            yield f"{prefix}_{self.name}_count{format_labels(labels)} {total}"
+
+
+def format_labels(labels):
+    labels = [f'{name}="{str(value)}"' for name, value in labels]
+    return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+
+def metric_name(*parts):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "_".join(str(part) for part in parts))
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+http_requests = Counter("http_requests_total", "Outbound requests by host and status", ("host", "status"))
+http_latency = Histogram("http_request_seconds", "Latency of outbound requests by host", ("host",))
+http_retries = Counter("http_retries_total", "Retried outbound requests by host", ("host",))
+db_queries = Histogram("db_query_seconds", "Duration of database queries",
+                       buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1))
+
+
+def record_retry(url):
+    http_retries.inc(urlparse(url).hostname)
+
+
+def register_section(name, func):
+    """Add the stats of some part of the bot, func returns a dict of numbers or a dict of dicts of numbers"""
+    sections[name] = func
+
+
+def http_stats():
+    hosts = defaultdict(lambda: {"requests": 0, "errors": 0, "429": 0, "retries": 0, "avg_ms": 0.0})
+    for (host, status), count in http_requests.values.items():
+        hosts[host]["requests"] += count
+        hosts[host]["errors"] += count if status >= 400 else 0
+        hosts[host]["429"] += count if status == 429 else 0
+    for (host,), count in http_retries.values.items():
+        hosts[host]["retries"] += count
+    for (host,), total in http_latency.sums.items():
+        hosts[host]["avg_ms"] = round(1000 * total / max(http_latency.count(host), 1), 1)
+    return dict(hosts)
+
+
+def db_stats():
+    count = db_queries.count()
+    return {"queries": count, "avg_ms": round(1000 * db_queries.sums[()] / count, 2) if count > 0 else 0.0}
+
+
+def snapshot():
+    """Current stats of every section, sections that fail are left out"""
+    stats = {"http": http_stats(), "db": db_stats()}
+    for name, func in sections.items():
+        try:
+            stats[name] = func()
+        except Exception:
+            logger.warning(f"Could not collect stats of {name}.", exc_info=True)
+    return stats
+
+
+def render():
+    """All metrics in the Prometheus text format"""
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.lines())
+
+    for section, stats in snapshot().items():
+        if section in ["http", "db"]:
+            continue
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                for field, field_value in value.items():
+                    if is_number(field_value):
+                        lines.append(f"{prefix}_{metric_name(section, field)}{format_labels([('name', key)])} "
+                                     f"{field_value}")
+            elif is_number(value):
+                lines.append(f"{prefix}_{metric_name(section, key)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """Human readable version of the stats, for !stats"""
+    def format_value(value):
+        return f"{value:.3g}" if isinstance(value, float) else str(value)
+
+    output = ""
+    for section, stats in snapshot().items():
+        output += f"**{section}**\n"
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                fields = ", ".join(f"{field} {format_value(v)}" for field, v in value.items() if v is not None)
+                output += f"- {key}: {fields}\n"
+            else:
+                output += f"- {key}: {format_value(value)}\n"
+    return output
+
+
+async def handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(port):
+    """Serve the metrics on a local port, returns the runner to clean up"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logger.info(f"Serving metrics on port {port}.")
+    return runner
+
+
+@contextlib.contextmanager
+def timed(histogram, *label_values):
+    """Time a block into a histogram"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        histogram.observe(time.monotonic() - start, *label_values)
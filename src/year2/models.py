@@ -1,7 +1,26 @@
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
+
+from metrics import db_queries, timed
+
+
+class TimedSqliteDatabase(SqliteDatabase):
+    """Records how long every query takes"""
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        with timed(db_queries):
+            return super().execute_sql(sql, params, *args, **kwargs)
+
 
 # Initialize the database
-db = SqliteDatabase('data/db.sqlite')
+# WAL lets command reads go on while the background refresh writes
+db = TimedSqliteDatabase('data/db.sqlite', pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',  # Safe with WAL, only the last transactions can be lost on power failure
+    'cache_size': -64 * 1024,  # 64MB
+    'temp_store': 'memory',
+    'busy_timeout': 5000,
+})
 
 
 class BaseModel(Model):
@@ -27,7 +46,155 @@ class Entry(BaseModel):
     points = FloatField()
     points_expiry = DateTimeField()
 
+    class Meta:
+        indexes = (
+            (('season', 'points'), False),
+            (('season', 'points_expiry'), False),
+            (('user', 'season'), False),
+        )
+
+
+class EntryActivity(BaseModel):
+    """What the refresh interval of an entry is based on, points_expiry of the entry is its next refresh"""
+    entry = ForeignKeyField(Entry, primary_key=True, backref='activity', on_delete='CASCADE')
+    recent_kills = IntegerField(default=0)
+    last_queried = DateTimeField(null=True)
+    interval = FloatField(default=0)  # seconds
+
+
+class Killmail(BaseModel):
+    kill_id = IntegerField(primary_key=True)
+    kill_hash = CharField()
+    data = BlobField()  # zlib compressed ESI killmail json
+
+
+class KillType(BaseModel):
+    """Ships on a kill by type, to find the kills affected by a changed point value"""
+    type_id = IntegerField()
+    kill_id = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('type_id', 'kill_id')
+
+
+class CharacterKill(BaseModel):
+    character_id = IntegerField()
+    kill_id = IntegerField()
+    kill_hash = CharField()
+
+    class Meta:
+        primary_key = CompositeKey('character_id', 'kill_id')
+
+
+class KillCursor(BaseModel):
+    character_id = IntegerField(primary_key=True)
+    start = DateTimeField()  # Kills are known back to this time
+    newest_kill_id = IntegerField()  # High-water mark of the last refresh
+    oldest_kill_id = IntegerField()  # Oldest kill found on the initial walk
+    pages = IntegerField()  # Number of pages of the initial walk
+    corporation_id = IntegerField(null=True)  # Affiliation of the character at its last own refresh
+    alliance_id = IntegerField(null=True)
+
+
+class GroupCursor(BaseModel):
+    """Like KillCursor, for the kills of a whole corporation or alliance"""
+    entity = CharField()  # corporationID or allianceID
+    group_id = IntegerField()
+    start = DateTimeField()
+    newest_kill_id = IntegerField()
+    oldest_kill_id = IntegerField()
+    pages = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('entity', 'group_id')
+
+
+class KillScore(BaseModel):
+    rules_version = CharField()
+    character_id = IntegerField()
+    kill_id = IntegerField()
+    kill_time = DateTimeField()
+    score = FloatField()
+    time_bracket = FloatField()  # seconds
+
+    class Meta:
+        primary_key = CompositeKey('rules_version', 'character_id', 'kill_id')
+
+
+class ScoreGroup(BaseModel):
+    rules_version = CharField()
+    character_id = IntegerField()
+    first_kill_id = IntegerField()
+    end_time = DateTimeField()
+    score = FloatField()
+    kills = TextField()  # json list of [kill_id, kill_score]
+
+    class Meta:
+        primary_key = CompositeKey('rules_version', 'character_id', 'first_kill_id')
+        indexes = (
+            (('rules_version', 'character_id', 'score'), False),
+        )
+
+
+class Name(BaseModel):
+    """Names of characters, corporations and alliances as resolved by ESI"""
+    entity_id = IntegerField(primary_key=True)
+    name = CharField()
+    category = CharField()
+    updated = DateTimeField()
+
+
+class ItemType(BaseModel):
+    type_id = IntegerField(primary_key=True)
+    name = CharField()
+    meta_level = FloatField()
+    low_slots = IntegerField()
+    mid_slots = IntegerField()
+    high_slots = IntegerField()
+
+
+def add_column(model, name):
+    """Migration step adding a column of a model, unless the table was created with it already"""
+    def add():
+        field = model._meta.fields[name]
+        if field.column_name not in [column.name for column in db.get_columns(model._meta.table_name)]:
+            migrate(SqliteMigrator(db).add_column(model._meta.table_name, field.column_name, field))
+    return add
+
+
+# Changes that create_tables does not make, by schema version. Run after it, so also on new databases.
+migrations = [
+    [
+        'CREATE INDEX IF NOT EXISTS "entry_season_id_points" ON "entry" ("season_id", "points")',
+        'CREATE INDEX IF NOT EXISTS "entry_season_id_points_expiry" ON "entry" ("season_id", "points_expiry")',
+        'CREATE INDEX IF NOT EXISTS "entry_user_id_season_id" ON "entry" ("user_id", "season_id")',
+    ],
+    [
+        # Case insensitive lookups of names
+        'CREATE INDEX IF NOT EXISTS "name_lower_name_category" ON "name" (lower("name"), "category")',
+    ],
+    [
+        add_column(KillCursor, "corporation_id"),
+        add_column(KillCursor, "alliance_id"),
+    ],
+]
+
+
+def migrate_database():
+    """Apply all migrations newer than the schema version of the database, kept in user_version"""
+    version = db.pragma('user_version')
+    for number, statements in enumerate(migrations[version:], version + 1):
+        with db.atomic():
+            for statement in statements:
+                if callable(statement):
+                    statement()
+                else:
+                    db.execute_sql(statement)
+            db.pragma('user_version', number)
+
 
 def initialize_database():
     with db:
-        db.create_tables([User, Season, Entry])
+        db.create_tables([User, Season, Entry, Killmail, ItemType, CharacterKill, KillCursor, KillScore, KillType,
+                          ScoreGroup, GroupCursor, EntryActivity, Name])
+        migrate_database()
@@ -2,26 +2,75 @@ import asyncio
 import json
 import logging
 import ssl
-from datetime import datetime
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta
 
 import aiohttp
-import async_lru
 import certifi
+from peewee import chunked, fn
+
+from broker import broker
+from cache import Cache, cached
+from metrics import record_retry
+from models import db, Killmail, ItemType, CharacterKill, KillCursor, KillType, GroupCursor, Name
 
 # Configure the logger
 logger = logging.getLogger('discord.network')
 logger.setLevel(logging.ERROR)
 
-kill_cache = {}
+# Everything the bot needs to know about a type
+TypeInfo = namedtuple("TypeInfo", ["name", "meta_level", "slots"])
+
+# Hit / miss counts of the on-disk killmail store
+killmail_store_stats = {"hits": 0, "misses": 0}
+
+# Characters of all entries, every stored killmail credits the ones among its attackers
+linked_characters = set()
+
+# Names by id, in front of the name store
+name_cache = Cache("name", maxsize=10000, ttl=24 * 3600)
+
+# Names being resolved right now by id, concurrent lookups wait for those instead of asking again
+pending_names = {}
+
+# Ids that /universe/names/ does not know, a single one of them fails a whole request
+invalid_ids = Cache("invalid_id", maxsize=10000, ttl=24 * 3600)
+
+# Names that could not be resolved to an id, by (normalized name, category)
+unknown_names = Cache("unknown_name", maxsize=10000, ttl=10 * 60)
 
-# Limit all ESI things to 50 concurrent requests
-esi_semaphore = asyncio.BoundedSemaphore(50)
-error_limit = 100
-error_delay = 0
+# Names waiting to be resolved to ids together, by normalized name
+id_batch = {}
+
+# Seconds to wait for more names before resolving a batch
+id_batch_delay = 0.05
+
+# Running batch resolutions, referenced so they are not garbage collected
+id_batch_tasks = set()
+
+# Categories of /universe/ids/ that are kept in the name store, with the category used by /universe/names/
+name_categories = {"characters": "character", "corporations": "corporation", "alliances": "alliance"}
+
+# Stored names older than this are resolved again
+name_ttl = timedelta(days=7)
+
+# Corporation and alliance of characters by character_id
+affiliation_cache = Cache("affiliation", maxsize=10000, ttl=6 * 3600)
 
 import random
 import string
-import asyncio
+
+
+def create_session():
+    """
+    Create the pooled session shared by the whole bot.
+    Connections are kept alive and DNS lookups cached, so TLS handshakes are only paid once per connection.
+    """
+    ssl_context = ssl.create_default_context(cafile=certifi.where())
+    connector = aiohttp.TCPConnector(ssl=ssl_context, limit=100, limit_per_host=50, keepalive_timeout=60,
+                                     ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60))
 
 
 def generate_headers(url):
@@ -39,48 +88,101 @@ def generate_headers(url):
     return headers
 
 async def get(session, url) -> dict:
-    # Wait for ESI errors to pass
-    if "esi.evetech.net" in url:
-        global error_limit, error_delay
-        if error_limit < 1:
-            await asyncio.sleep(error_delay)
-            error_limit = 100
+    # Retry logic with dynamic User-Agent for esi.evetech.net
+    for attempt in range(20 if "esi.evetech.net" in url else 5):
+
+        async with broker.request(session, "GET", url, headers=generate_headers(url)) as response:
 
-    async with esi_semaphore:
+            if response.status == 200:
+                try:
+                    return await response.json(content_type=None)
+                except Exception as e:
+                    logger.warning(f"Error {e} with ESI {response.status}: {await response.text()}")
+            else:
+                logger.warning(f"Error with ESI {response.status}: {await response.text()}")
+
+        # Retry with backoff if esi.evetech.net, rate limits are handled by the broker
+        record_retry(url)
+        if "esi.evetech.net" in url:
+            await asyncio.sleep(0.5 * (attempt + 1))  # Linear backoff
+        else:
+            await asyncio.sleep(0.25 * (attempt + 1) ** 3)  # Cubic backoff
 
-        # Retry logic with dynamic User-Agent for esi.evetech.net
-        for attempt in range(20 if "esi.evetech.net" in url else 5):
+    raise ValueError(f"Could not fetch data from {url}!")
 
-            async with session.get(url, headers=generate_headers(url)) as response:
 
-                # Handle error limit headers for esi.evetech.net
-                if "esi.evetech.net" in url:
-                    current_error_limit = int(response.headers.get("X-Esi-Error-Limit-Remain", 100))
-                    error_limit = min(error_limit, current_error_limit)
-                    error_delay = int(response.headers.get("X-Esi-Error-Limit-Reset", 0))
+def normalize_name(string):
+    """EVE names are unique regardless of case and extra whitespace"""
+    return " ".join(string.split()).lower()
 
-                if response.status == 200:
-                    try:
-                        return await response.json(content_type=None)
-                    except Exception as e:
-                        logger.warning(f"Error {e} with ESI {response.status}: {await response.text()}")
-                else:
-                    logger.warning(f"Error with ESI {response.status}: {await response.text()}")
 
-                # Retry with backoff if esi.evetech.net
-                if "esi.evetech.net" in url:
-                    await asyncio.sleep(0.5 * (attempt + 1))  # Linear backoff
-                else:
-                    await asyncio.sleep(0.25 * (attempt + 1) ** 3)  # Cubic backoff
+async def resolve_ids(session, names):
+    """Resolve names with /universe/ids/ in one request, returns a dict of name to a dict of category to id.
+    Characters, corporations and alliances found are put into the name store."""
+    async with broker.request(
+            session, "POST", 'https://esi.evetech.net/latest/universe/ids/?datasource=tranquility&language=en',
+            json=names) as response:
+        if response.status != 200:
+            raise ValueError(f"Could not resolve ids: {await response.text()}")
+        results = await response.json(content_type=None)
+
+    ids = {}
+    rows = []
+    for category, matches in results.items():
+        for match in matches:
+            category_ids = ids.setdefault(normalize_name(match["name"]), {})
+            category_ids[category] = max(category_ids.get(category, 0), int(match["id"]))
+            if category in name_categories:
+                rows.append({"entity_id": int(match["id"]), "name": match["name"],
+                             "category": name_categories[category], "updated": datetime.utcnow()})
 
-        raise ValueError(f"Could not fetch data from {url}!")
+    with db.atomic():
+        for batch in chunked(rows, 100):
+            Name.insert_many(batch).on_conflict_replace().execute()
 
+    return ids
 
-async def lookup(string, return_type):
+
+async def flush_id_batch(session):
+    """Resolve all names that came in during the batch delay, in as few requests as possible.
+    Every waiting lookup gets a result or an error, whatever happens to the batch."""
+    batch = None
+    try:
+        await asyncio.sleep(id_batch_delay)
+        batch = dict(id_batch)
+        id_batch.clear()
+
+        for name_chunk in chunked(list(batch), 500):
+            try:
+                ids = await resolve_ids(session, name_chunk)
+            except (ValueError, json.JSONDecodeError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                for name in name_chunk:
+                    batch[name].set_exception(ValueError("Could not parse that character!"))
+                logger.warning(f"Could not resolve {len(name_chunk)} names: {e}")
+            else:
+                for name in name_chunk:
+                    batch[name].set_result(ids.get(name, {}))
+    except Exception:
+        logger.error("Could not resolve a batch of names.", exc_info=True)
+    finally:
+        if batch is None:
+            # Stopped before the batch was taken
+            batch = dict(id_batch)
+            id_batch.clear()
+        for future in batch.values():
+            if not future.done():
+                future.set_exception(ValueError("Could not parse that character!"))
+
+
+async def lookup(session, string, return_type):
     """Tries to find an ID related to the input.
+    Known names are read from the name store, names that could not be found are remembered for a while,
+    all other names looked up at the same time are resolved together.
 
     Parameters
     ----------
+    session : aiohttp.ClientSession
+        The pooled session of the bot
     string : str
         The character / corporation / alliance name
     return_type : str
@@ -94,70 +196,196 @@ async def lookup(string, return_type):
     try:
         return int(string)
     except ValueError:
-        try:
-            ssl_context = ssl.create_default_context(cafile=certifi.where())
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_context)) as session:
-                async with session.post(
-                        'https://esi.evetech.net/latest/universe/ids/?datasource=tranquility&language=en',
-                        json=[string]) as response:
-                    results = (await response.json())[return_type]
-                    return int(max(results, key=lambda x: x["id"])["id"])
-        except (ValueError, json.JSONDecodeError, KeyError):
-            raise ValueError("Could not parse that character!")
-
-
-@async_lru.alru_cache(maxsize=40000)
+        pass
+
+    name = normalize_name(string)
+    if (name, return_type) in unknown_names:
+        raise ValueError("Could not parse that character!")
+
+    row = Name.select().where((fn.lower(Name.name) == name) & (Name.category == name_categories.get(return_type))) \
+        .order_by(Name.entity_id.desc()).first()
+    if row is not None:
+        return row.entity_id
+
+    if name not in id_batch:
+        if len(id_batch) == 0:
+            task = asyncio.create_task(flush_id_batch(session))
+            id_batch_tasks.add(task)
+            task.add_done_callback(id_batch_tasks.discard)
+        id_batch[name] = asyncio.get_running_loop().create_future()
+    ids = await asyncio.shield(id_batch[name])
+
+    if return_type not in ids:
+        unknown_names.set((name, return_type), True)
+        raise ValueError("Could not parse that character!")
+    return ids[return_type]
+
+
+def parse_item_type(type_id, name, dogma_attributes):
+    """Condense the ESI / static data of a type into the fields of the type store"""
+    item_type = {"type_id": type_id, "name": name, "meta_level": None, "low_slots": 0, "mid_slots": 0,
+                 "high_slots": 0}
+    for dogma_attribute in dogma_attributes:
+        attribute_id = int(dogma_attribute.get("attribute_id", 0))
+        if attribute_id in [1692, 633] and item_type["meta_level"] is None:
+            item_type["meta_level"] = float(dogma_attribute.get("value", 5.0))
+        elif attribute_id == 12:
+            item_type["low_slots"] = int(dogma_attribute.get("value", 0))
+        elif attribute_id == 13:
+            item_type["mid_slots"] = int(dogma_attribute.get("value", 0))
+        elif attribute_id == 14:
+            item_type["high_slots"] = int(dogma_attribute.get("value", 0))
+
+    if item_type["meta_level"] is None:
+        item_type["meta_level"] = 5.0
+
+    return item_type
+
+
+def type_info(row):
+    return TypeInfo(row.name, row.meta_level, (row.low_slots, row.mid_slots, row.high_slots))
+
+
+async def fetch_item_type(session, type_id):
+    """Fetch a type from ESI and put it into the type store"""
+    data = await get(session, f"https://esi.evetech.net/latest/universe/types/{type_id}/")
+    item_type = parse_item_type(type_id, data["name"], data.get("dogma_attributes", []))
+    ItemType.insert(**item_type).on_conflict_replace().execute()
+    return TypeInfo(item_type["name"], item_type["meta_level"],
+                    (item_type["low_slots"], item_type["mid_slots"], item_type["high_slots"]))
+
+
+@cached("item_type", maxsize=100000, ttl=7 * 24 * 3600)
+async def get_item_type(session, type_id):
+    """Name, meta level and slots of a type, from the type store or ESI"""
+    try:
+        return type_info(ItemType.get_by_id(type_id))
+    except ItemType.DoesNotExist:  # noqa
+        return await fetch_item_type(session, type_id)
+
+
+async def get_item_types(session, type_ids):
+    """Bulk version of get_item_type, returns a dict of type_id to TypeInfo.
+    Types not in memory are read from the type store at once, only unknown ones are fetched from ESI."""
+    type_ids = set(type_ids)
+    item_types = {}
+    for type_id in type_ids:
+        found, value = get_item_type.cache.get((type_id,))
+        if found:
+            item_types[type_id] = value
+
+    for type_id_chunk in chunked(type_ids - item_types.keys(), 500):
+        for row in ItemType.select().where(ItemType.type_id.in_(type_id_chunk)):
+            item_types[row.type_id] = type_info(row)
+            get_item_type.cache.set((row.type_id,), item_types[row.type_id])
+
+    missing = list(type_ids - item_types.keys())
+    item_types.update(zip(missing, await asyncio.gather(*[get_item_type(session, t) for t in missing])))
+
+    return item_types
+
+
 async def get_item_name(session, type_id):
     try:
-        return (await get(session, f"https://esi.evetech.net/latest/universe/types/{type_id}/"))["name"]
+        return (await get_item_type(session, type_id)).name
     except ValueError:
         return f"Type ID: {type_id}"
 
 
-@async_lru.alru_cache(maxsize=1000)
-async def get_character_name(session, character_id):
+async def resolve_names(session, ids):
+    """Resolve ids with /universe/names/, returns a dict of id to (name, category).
+    ESI rejects the whole request if any id is invalid, so rejected requests are split in halves
+    until the invalid ids are found. Those are remembered in invalid_ids and left out."""
+    async with broker.request(session, "POST", "https://esi.evetech.net/latest/universe/names/", json=ids) as response:
+        if response.status == 200:
+            return {row["id"]: (row["name"], row["category"]) for row in await response.json(content_type=None)}
+        if response.status not in [400, 404]:
+            raise ValueError(f"Could not resolve names: {await response.text()}")
+
+    if len(ids) == 1:
+        logger.warning(f"Could not resolve the name of invalid id {ids[0]}.")
+        invalid_ids.set(ids[0], True)
+        return {}
+    half = len(ids) // 2
+    return await resolve_names(session, ids[:half]) | await resolve_names(session, ids[half:])
+
+
+async def get_names(session, ids):
+    """Names of many characters (or corporations, alliances), as a dict of id to name.
+    Names are read from memory and the name store first, all others are resolved in chunks of 1000 ids."""
+    ids = {int(entity_id) for entity_id in ids}
+    names = {}
+    for entity_id in ids:
+        found, value = name_cache.get(entity_id)
+        if found:
+            names[entity_id] = value
+
+    for id_chunk in chunked(ids - names.keys(), 500):
+        query = Name.select().where(Name.entity_id.in_(id_chunk) & (Name.updated > datetime.utcnow() - name_ttl))
+        for row in query:
+            names[row.entity_id] = row.name
+            name_cache.set(row.entity_id, row.name)
+
+    for entity_id in ids - names.keys():
+        if entity_id in invalid_ids:
+            names[entity_id] = f"Character ID: {entity_id}"
+
+    # Ids someone else is resolving already are awaited, the rest is resolved here
+    missing = ids - names.keys()
+    waiting = {entity_id: pending_names[entity_id] for entity_id in missing if entity_id in pending_names}
+    resolving = {entity_id: asyncio.get_running_loop().create_future() for entity_id in missing - waiting.keys()}
+    pending_names.update(resolving)
+
     try:
-        return (await get(session, f"https://esi.evetech.net/latest/characters/{character_id}/"))["name"]
-    except ValueError:
-        return f"Character ID: {character_id}"
+        for id_chunk in chunked(list(resolving), 1000):
+            try:
+                resolved = await resolve_names(session, id_chunk)
+            except (ValueError, aiohttp.ClientError, asyncio.TimeoutError):
+                logger.warning(f"Could not resolve {len(id_chunk)} names.", exc_info=True)
+                resolved = {}
+
+            rows = [{"entity_id": entity_id, "name": name, "category": category, "updated": datetime.utcnow()}
+                    for entity_id, (name, category) in resolved.items()]
+            with db.atomic():
+                for batch in chunked(rows, 100):
+                    Name.insert_many(batch).on_conflict_replace().execute()
+
+            for entity_id in id_chunk:
+                if entity_id in resolved:
+                    name_cache.set(entity_id, resolved[entity_id][0])
+                resolving[entity_id].set_result(resolved[entity_id][0] if entity_id in resolved
+                                                else f"Character ID: {entity_id}")
+    finally:
+        for entity_id, future in resolving.items():
+            pending_names.pop(entity_id, None)
+            if not future.done():
+                future.cancel()
+
+    for entity_id, future in (waiting | resolving).items():
+        await asyncio.wait([future])
+        names[entity_id] = future.result() if not future.cancelled() else f"Character ID: {entity_id}"
+
+    return names
+
+
+async def get_character_name(session, character_id):
+    return (await get_names(session, [character_id]))[int(character_id)]
 
 
-@async_lru.alru_cache(maxsize=100000)
 async def get_item_metalevel(session, type_id):
-    try:
-        for dogma_attribute in \
-                (await get(session, f"https://esi.evetech.net/latest/universe/types/{type_id}/"))[
-                    "dogma_attributes"]:
-            if int(dogma_attribute.get("attribute_id", 0)) in [1692, 633]:
-                return float(dogma_attribute.get("value", 5.0))
-    except KeyError:
-        pass
-    return 5.0
+    return (await get_item_type(session, type_id)).meta_level
 
 
-@async_lru.alru_cache(maxsize=500)
 async def get_ship_slots(session, type_id):
-    low_slots = 0
-    mid_slots = 0
-    high_slots = 0
-    for dogma_attribute in (await get(session, f"https://esi.evetech.net/latest/universe/types/{type_id}/"))[
-        "dogma_attributes"]:
-        attribute_id = int(dogma_attribute.get("attribute_id", 0))
-        attribute_value = int(dogma_attribute.get("value", 0))
-        if attribute_id == 12:
-            low_slots = attribute_value
-        elif attribute_id == 13:
-            mid_slots = attribute_value
-        elif attribute_id == 14:
-            high_slots = attribute_value
-    return low_slots, mid_slots, high_slots
+    return (await get_item_type(session, type_id)).slots
 
 
-@async_lru.alru_cache(maxsize=40000)
+@cached("kill_hash", maxsize=40000)
 async def get_hash(session, kill_id):
-    async with session.get(f"https://zkillboard.com/api/kills/killID/{kill_id}/") as response:
+    url = f"https://zkillboard.com/api/kills/killID/{kill_id}/"
 
-        for attempt in range(5):
+    for attempt in range(5):
+        async with broker.request(session, "GET", url, headers=generate_headers(url)) as response:
             if response.status == 200:
                 try:
                     return (await response.json(content_type=None))[0]["zkb"]["hash"]
@@ -166,24 +394,110 @@ async def get_hash(session, kill_id):
             elif response.status == 429:
                 logger.warning(f"To many requests while trying to get hash {kill_id}")
 
-            await asyncio.sleep(0.5 * (attempt + 1) ** 3)  # backoff
+        record_retry(url)
+        await asyncio.sleep(0.5 * (attempt + 1) ** 3)  # backoff
 
     raise ValueError(f"Could not fetch data from zkillboard.com!")
 
 
-@async_lru.alru_cache(maxsize=40000)
+def load_kills(kill_ids):
+    """Bulk read killmails from the on-disk store, returns a dict of kill_id to killmail for the ones found"""
+    kill_ids = list(kill_ids)
+    kills = {}
+    for kill_id_chunk in chunked(kill_ids, 500):
+        for row in Killmail.select().where(Killmail.kill_id.in_(kill_id_chunk)):
+            kills[row.kill_id] = json.loads(zlib.decompress(row.data))
+
+    killmail_store_stats["hits"] += len(kills)
+    killmail_store_stats["misses"] += len(kill_ids) - len(kills)
+    logger.debug(f"Killmail store: {len(kills)} of {len(kill_ids)} kills found.")
+
+    return kills
+
+
+def kill_types(kill):
+    """All ship types on a kill that point values are looked up for"""
+    type_ids = {kill.get("victim", {}).get("ship_type_id", 0)}
+    type_ids.update(attacker.get("ship_type_id", 0) for attacker in kill.get("attackers", []))
+    return type_ids
+
+
+def participants(kill):
+    """Linked characters among the attackers of a kill"""
+    return {int(attacker["character_id"]) for attacker in kill.get("attackers", [])
+            if "character_id" in attacker} & linked_characters
+
+
+def store_kill(kill_id, kill_hash, kill):
+    """Write a killmail to the on-disk store. Killmails never change once id and hash are known.
+    Every linked character on the kill gets it added to their kills, without crawling zkillboard for it."""
+    with db.atomic():
+        Killmail.insert(
+            kill_id=kill_id, kill_hash=kill_hash, data=zlib.compress(json.dumps(kill).encode())
+        ).on_conflict_ignore().execute()
+        KillType.insert_many(
+            [{"type_id": type_id, "kill_id": kill_id} for type_id in kill_types(kill)]
+        ).on_conflict_ignore().execute()
+        credit_participants({kill_id: kill_hash}, {kill_id: kill})
+
+
+def credit_participants(kills, kill_data):
+    """Add killmails to the kills of every linked character on them, whether they were stored before or not.
+    kills is a dict of kill_id to kill_hash, kill_data a dict of kill_id to killmail."""
+    rows = [{"character_id": character_id, "kill_id": kill_id, "kill_hash": kills[kill_id]}
+            for kill_id, kill in kill_data.items() for character_id in participants(kill)]
+    with db.atomic():
+        for batch in chunked(rows, 100):
+            CharacterKill.insert_many(batch).on_conflict_ignore().execute()
+
+
+def index_kill_types():
+    """Add stored killmails that are missing from the type index"""
+    query = Killmail.select().where(Killmail.kill_id.not_in(KillType.select(KillType.kill_id)))
+    with db.atomic():
+        for row in query:
+            kill = json.loads(zlib.decompress(row.data))
+            KillType.insert_many(
+                [{"type_id": type_id, "kill_id": row.kill_id} for type_id in kill_types(kill)]
+            ).on_conflict_ignore().execute()
+
+
+@cached("kill", maxsize=40000)
 async def get_kill(session, kill_id, kill_hash):
-    """Fetch a kill from ESI based on its id and hash"""
-    return await get(session, f"https://esi.evetech.net/latest/killmails/{kill_id}/{kill_hash}/")
+    """Fetch a kill based on its id and hash, first from the on-disk store, then from ESI"""
+    stored_kills = load_kills([kill_id])
+    if kill_id in stored_kills:
+        return stored_kills[kill_id]
+
+    return await fetch_kill(session, kill_id, kill_hash)
 
 
-async def get_kill_page(session, character_id, page):
-    url = f"https://zkillboard.com/api/kills/characterID/{character_id}/kills/page/{page}/"
+async def fetch_kill(session, kill_id, kill_hash):
+    """Fetch a kill from ESI and put it into the on-disk store"""
+    kill = await get(session, f"https://esi.evetech.net/latest/killmails/{kill_id}/{kill_hash}/")
+    store_kill(kill_id, kill_hash, kill)
+    return kill
 
-    async with session.get(url) as response:
-        kills = []
-        success = False
-        for attempt in range(5):
+
+async def get_kills(session, kills):
+    """Fetch many kills given as a dict of kill_id to kill_hash.
+    Stored kills are read in one bulk lookup, only the missing ones are fetched from ESI."""
+    stored_kills = load_kills(kills.keys())
+
+    missing = [(kill_id, kill_hash) for kill_id, kill_hash in kills.items() if kill_id not in stored_kills]
+    fetched_kills = await asyncio.gather(*[fetch_kill(session, kill_id, kill_hash) for kill_id, kill_hash in missing])
+
+    stored_kills.update({kill_id: kill for (kill_id, _), kill in zip(missing, fetched_kills)})
+    return stored_kills
+
+
+async def get_kill_page(session, entity_id, page, entity="characterID"):
+    url = f"https://zkillboard.com/api/kills/{entity}/{entity_id}/kills/page/{page}/"
+
+    kills = []
+    success = False
+    for attempt in range(5):
+        async with broker.request(session, "GET", url, headers=generate_headers(url)) as response:
             if response.status == 200:
                 try:
                     kills = await response.json(content_type=None)
@@ -193,29 +507,52 @@ async def get_kill_page(session, character_id, page):
                     success = True
                     break
             elif response.status == 429:
-                logger.warning(f"To many requests with user {character_id} on page {page}")
-                raise ValueError(f"Could not fetch data from character {character_id}!")
+                logger.warning(f"To many requests with {entity} {entity_id} on page {page}")
 
-            await asyncio.sleep(0.5 * (attempt + 1) ** 3)  # backoff
+        record_retry(url)
+        await asyncio.sleep(0.5 * (attempt + 1) ** 3)  # backoff
 
-        if not success:
-            raise ValueError(f"Could not fetch data from character {character_id}!")
+    if not success:
+        raise ValueError(f"Could not fetch data from {entity} {entity_id}!")
 
-        # Extract data, which might be differently encoded depending on how zkill does it
-        if type(kills) is not dict:
-            kills = {kill["killmail_id"]: kill["zkb"]["hash"] for kill in kills}
+    # Extract data, which might be differently encoded depending on how zkill does it
+    if type(kills) is not dict:
+        kills = {kill["killmail_id"]: kill["zkb"]["hash"] for kill in kills}
 
-        # Filter out wired kills that do not actually exist !?
-        kills = {k: h for k, h in kills.items() if h != "CCP VERIFIED"}
+    # Filter out wired kills that do not actually exist !?
+    kills = {k: h for k, h in kills.items() if h != "CCP VERIFIED"}
 
     return kills
 
 
+def known_kills(character_id, oldest_kill_id=0):
+    """All kills of a character found so far, as a dict of kill_id to kill_hash"""
+    query = CharacterKill.select().where(
+        (CharacterKill.character_id == character_id) & (CharacterKill.kill_id >= oldest_kill_id))
+    return {row.kill_id: row.kill_hash for row in query}
+
+
+def store_character_kills(character_id, kills):
+    rows = [{"character_id": character_id, "kill_id": k, "kill_hash": h} for k, h in kills.items()]
+    with db.atomic():
+        for batch in chunked(rows, 100):
+            CharacterKill.insert_many(batch).on_conflict_ignore().execute()
+
+
+@cached("kill_pages", maxsize=1000, ttl=60, key=lambda character_id, start: (int(character_id), start))
 async def get_kill_pages(session, character_id, start):
     """Fetch all kills for a character up to a certain start time.
-    Start time is inexact, some kills before might be returned"""
-    over = False
+    Start time is inexact, some kills before might be returned.
+
+    Each character keeps a cursor with the newest kill seen. Once the kills back to start are known,
+    only the pages newer than that kill are fetched, and no killmails are needed to find the boundary.
+    Concurrent calls for the same character share one crawl, and its result for a minute."""
+    cursor = KillCursor.get_or_none(KillCursor.character_id == character_id)
+    incremental = cursor is not None and cursor.start == start
 
+    newest_kill_id = None
+    oldest_kill_id = None
+    page = 0
     for page in range(1, 100):
         kills = await get_kill_page(session, character_id, page)
 
@@ -223,32 +560,109 @@ async def get_kill_pages(session, character_id, start):
         if len(kills) == 0:
             break
 
+        store_character_kills(character_id, kills)
+        newest_kill_id = max(kills) if newest_kill_id is None else max(newest_kill_id, max(kills))
+        oldest_kill_id = min(kills)
+
+        # If the oldest kill on this page is already known we have reached far enough
+        # (Kills getting added later on far in the past are ignored)
+        if incremental:
+            logger.debug(f"Page {page}: first kill_id {oldest_kill_id}, known up to {cursor.newest_kill_id}")
+            if oldest_kill_id <= cursor.newest_kill_id:
+                break
+            continue
+
         # Check if the last kill (smallest id) is old enough
-        kill_id, kill_hash = min(kills.items(), key=lambda x: x[0])
-        first_kill = await get_kill(session, kill_id, kill_hash)
+        first_kill = await get_kill(session, oldest_kill_id, kills[oldest_kill_id])
         first_kill_time = datetime.strptime(first_kill.get('killmail_time'), '%Y-%m-%dT%H:%M:%SZ')
 
-        logger.debug(f"Page {page}: first kill_id {kill_id}, time {first_kill_time}-")
+        logger.debug(f"Page {page}: first kill_id {oldest_kill_id}, time {first_kill_time}")
         if first_kill_time < start:
-            over = True
+            break
 
-        # If the last kill is already in the stored data we have reached far enough
-        # (Kills getting added later on far in the past are ignored)
-        if character_id in kill_cache and kill_id in kill_cache[character_id]:
-            over = True
+    # Remember how far the kills of this character are known
+    if incremental:
+        if newest_kill_id is not None and newest_kill_id > cursor.newest_kill_id:
+            cursor.newest_kill_id = newest_kill_id
+            cursor.save()
+        oldest_kill_id = cursor.oldest_kill_id
+    elif newest_kill_id is not None:
+        KillCursor.replace(character_id=character_id, start=start, newest_kill_id=newest_kill_id,
+                           oldest_kill_id=oldest_kill_id, pages=page).execute()
+    else:
+        return {}
+
+    return known_kills(character_id, oldest_kill_id)
+
+
+async def get_affiliations(session, character_ids):
+    """Corporation and alliance of many characters, as a dict of character_id to (corporation_id, alliance_id)"""
+    affiliations = {}
+    for character_id in character_ids:
+        found, value = affiliation_cache.get(character_id)
+        if found:
+            affiliations[character_id] = value
+
+    for character_id_chunk in chunked(set(character_ids) - affiliations.keys(), 1000):
+        async with broker.request(session, "POST", "https://esi.evetech.net/latest/characters/affiliation/",
+                                  json=character_id_chunk) as response:
+            if response.status != 200:
+                raise ValueError(f"Could not fetch affiliations: {await response.text()}")
+            for affiliation in await response.json(content_type=None):
+                value = (affiliation["corporation_id"], affiliation.get("alliance_id"))
+                affiliations[affiliation["character_id"]] = value
+                affiliation_cache.set(affiliation["character_id"], value)
+
+    return affiliations
+
+
+async def get_group_kill_pages(session, entity, group_id, start):
+    """Fetch all kills of a corporation or alliance up to a certain start time, see get_kill_pages.
+    All killmails are fetched, so the linked characters on them are credited with the kill.
+    Returns the oldest kill id known for the group."""
+    cursor = GroupCursor.get_or_none((GroupCursor.entity == entity) & (GroupCursor.group_id == group_id))
+    incremental = cursor is not None and cursor.start == start
+
+    newest_kill_id = None
+    oldest_kill_id = None
+    page = 0
+    for page in range(1, 100):
+        kills = await get_kill_page(session, group_id, page, entity)
+        if len(kills) == 0:
+            break
 
-        # Update per character cache and get kills from it if there are any
-        if character_id in kill_cache:
-            kill_cache[character_id].update(kills)
-        else:
-            kill_cache[character_id] = kills
+        # Stored killmails are credited as well, they may predate a character being linked.
+        # Kills up to the cursor were credited by an earlier crawl.
+        new_kills = {k: h for k, h in kills.items() if not incremental or k > cursor.newest_kill_id}
+        kill_data = await get_kills(session, new_kills)
+        credit_participants(new_kills, kill_data)
+        newest_kill_id = max(kills) if newest_kill_id is None else max(newest_kill_id, max(kills))
+        oldest_kill_id = min(kills)
+
+        if incremental:
+            if oldest_kill_id <= cursor.newest_kill_id:
+                break
+        elif datetime.strptime(kill_data[oldest_kill_id]["killmail_time"], '%Y-%m-%dT%H:%M:%SZ') < start:
+            break
 
-        # Sleep on smaller pages to not trigger 429 on zkillboard.com
-        await asyncio.sleep(2)
+    logger.debug(f"Fetched {page} pages of {entity} {group_id}")
+
+    if incremental:
+        if newest_kill_id is not None and newest_kill_id > cursor.newest_kill_id:
+            cursor.newest_kill_id = newest_kill_id
+            cursor.save()
+        return cursor.oldest_kill_id
+    elif newest_kill_id is not None:
+        GroupCursor.replace(entity=entity, group_id=group_id, start=start, newest_kill_id=newest_kill_id,
+                            oldest_kill_id=oldest_kill_id, pages=page).execute()
+        return oldest_kill_id
+    else:
+        return None
 
-        if over:
-            break
 
-    if character_id in kill_cache:
-        return kill_cache[character_id]
-    return {}
+def prune_killmails():
+    """Remove stored killmails that credit no linked character, group crawls fetch many of those"""
+    credited = CharacterKill.select(CharacterKill.kill_id)
+    with db.atomic():
+        KillType.delete().where(KillType.kill_id.not_in(credited)).execute()
+        return Killmail.delete().where(Killmail.kill_id.not_in(credited)).execute()
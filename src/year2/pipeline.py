@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+
+# Configure the logger
+logger = logging.getLogger('discord.pipeline')
+logger.setLevel(logging.INFO)
+
+
+class Stage:
+    """
+    One step of a pipeline. A number of workers take items from the inbound queue of the stage
+    and put their results on the queue of the next stage. The queues are bounded, so a slow stage
+    holds back the stages in front of it instead of piling up work.
+    A stage that batches its results can give a flush function, called once the stage is drained.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=10, errors=(ValueError,), flush=None):
+        self.name = name
+        self.func = func
+        self.flush = flush
+        self.workers = workers
+        self.queue_size = queue_size
+        self.errors = errors
+
+        self.queue = None
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+
+    def stats(self, elapsed):
+        return {
+            "workers": self.workers,
+            "queue": self.queue.qsize() if self.queue is not None else 0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "per_second": self.processed / elapsed if elapsed > 0 else 0.0,
+            "busy_seconds": round(self.busy_time, 1),
+        }
+
+    async def work(self, next_stage):
+        while True:
+            item = await self.queue.get()
+            start = time.monotonic()
+            try:
+                result = await self.func(*item)
+            except self.errors:
+                self.failed += 1
+                logger.warning(f"Stage {self.name} failed, skipping.", exc_info=True)
+            except Exception:
+                # Keep the worker alive, otherwise the pipeline would never drain
+                self.failed += 1
+                logger.error(f"Unexpected error in stage {self.name}, skipping.", exc_info=True)
+            else:
+                self.processed += 1
+                if next_stage is not None and result is not None:
+                    await next_stage.queue.put(result)
+            finally:
+                self.busy_time += time.monotonic() - start
+                self.queue.task_done()
+
+
+class Pipeline:
+    """Stages joined by bounded queues, items given to run are passed through all stages"""
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.started = None
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started is not None else 0
+        return {stage.name: stage.stats(elapsed) for stage in self.stages}
+
+    async def run(self, items):
+        """Feed all items (tuples of arguments for the first stage) through the pipeline and wait until done"""
+        self.started = time.monotonic()
+        for stage in self.stages:
+            stage.queue = asyncio.Queue(maxsize=stage.queue_size)
+
+        next_stages = self.stages[1:] + [None]
+        workers = [asyncio.create_task(stage.work(next_stage))
+                   for stage, next_stage in zip(self.stages, next_stages)
+                   for _ in range(stage.workers)]
+
+        try:
+            for item in items:
+                await self.stages[0].queue.put(item)
+
+            # Every stage is drained only after the ones in front of it, so nothing is in flight anymore
+            for stage in self.stages:
+                await stage.queue.join()
+                if stage.flush is not None:
+                    try:
+                        await stage.flush()
+                    except Exception:
+                        logger.error(f"Could not flush stage {stage.name}.", exc_info=True)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        logger.info(f"Pipeline finished in {time.monotonic() - self.started:.1f}s: {self.stats()}")
@@ -1,35 +1,52 @@
 import asyncio
+import bisect
+import heapq
+import json
 import logging
 import math
+from collections import namedtuple
 from datetime import datetime, timedelta
 
-from network import get_item_metalevel, get_ship_slots, get_kill, get_kill_pages
+from peewee import chunked, Value
+
+from cache import Cache, cached
+from models import db, Entry, CharacterKill, KillScore, KillType, ScoreGroup
+from network import get_item_types, get_kill, get_kills, get_kill_pages
 
 # Configure the logger
 logger = logging.getLogger('discord.points')
 logger.setLevel(logging.ERROR)
 
-score_cache_dict = {}
+# Kill scores by rules version, kill and character. Changed rules never hit old scores.
+score_cache = Cache("kill_score", maxsize=200000)
 
 
-async def get_average_meta_level(session, kill):
-    """
-    Get the average meta level of the fitted items on a kill.
-    Deals with empty slots and averages them as meta level 0
-    """
-    meta_levels = {}
+def get_fitted_items(kill):
+    """Flag and type of every module fitted to the victim"""
+    fitted_items = []
     for item in kill.get("victim", {}).get("items", []):
         flag = int(item.get("flag", 0))
-        meta_level = await get_item_metalevel(session, item["item_type_id"])
         quantity = int(item.get("quantity_destroyed", 0) + item.get("quantity_dropped", 0))
         if 11 <= flag <= 34 and quantity == 1:
-            if flag in meta_levels:
-                meta_levels[flag] = max(meta_level, meta_levels[flag])
-            else:
-                meta_levels[flag] = meta_level
+            fitted_items.append((flag, item["item_type_id"]))
+    return fitted_items
+
+
+def average_meta_level(kill, item_types):
+    """
+    Get the average meta level of the fitted items on a kill, given the info of all types on it.
+    Deals with empty slots and averages them as meta level 0
+    """
+    meta_levels = {}
+    for flag, type_id in get_fitted_items(kill):
+        meta_level = item_types[type_id].meta_level
+        if flag in meta_levels:
+            meta_levels[flag] = max(meta_level, meta_levels[flag])
+        else:
+            meta_levels[flag] = meta_level
 
     # Average the meta level in the best available way
-    slots = (await get_ship_slots(session, kill["victim"]["ship_type_id"]))
+    slots = item_types[kill["victim"]["ship_type_id"]].slots
     if sum(slots) > 0:
         average_meta_level = sum(meta_levels.values()) / sum(slots)
     elif len(meta_levels) > 0:
@@ -42,11 +59,15 @@ async def get_average_meta_level(session, kill):
     return average_meta_level
 
 
-async def scale_score_on_meta_level(score, session, kill):
+async def get_average_meta_level(session, kill):
+    """Get the average meta level of the fitted items on a kill, looking up the ship and all items at once"""
+    type_ids = [kill["victim"]["ship_type_id"]] + [type_id for _, type_id in get_fitted_items(kill)]
+    return average_meta_level(kill, await get_item_types(session, type_ids))
+
+
+def meta_level_factor(meta_level):
     """
-    Adjust the score based on the meta levels / filled slots of the victim
-    - Figure out the metalevel of items
-    - Go through each slot, and find the module with the highest meta level in it to filter out ammo with meta level
+    Factor to adjust the score with based on the average meta level of the victim
 
     Meta-parameters:
     - neutral_input:  Meta level that results in no change
@@ -59,16 +80,24 @@ async def scale_score_on_meta_level(score, session, kill):
     expo = 0.8
     scaling = 0.5
 
-    meta_level = await get_average_meta_level(session, kill)
-
     # Linearly scale meta level into the range -1 ... something, with 0 for neutral element
     linear = (meta_level - neutral_input) / neutral_input
     # Apply exponentiation so that values of -1 and 1 stay the same, then scale the output
     exponential = linear * math.exp(abs(linear * expo)) * (scaling / math.exp(expo))
     # Move neutral element to desired output
-    factor = exponential + neutral_output
+    return exponential + neutral_output
+
+
+async def scale_score_on_meta_level(score, session, kill):
+    """
+    Adjust the score based on the meta levels / filled slots of the victim
+    - Figure out the metalevel of items
+    - Go through each slot, and find the module with the highest meta level in it to filter out ammo with meta level
+    """
+    meta_level = await get_average_meta_level(session, kill)
+
     # Apply factor to score
-    score *= factor
+    score *= meta_level_factor(meta_level)
 
     return score
 
@@ -122,22 +151,56 @@ def kill_is_valid(kill):
     return True
 
 
-async def get_kill_score(session, kill_id, kill_hash, rules, main_character_id=None):
-    """Fetch a single kill from ESI and calculate it's score according to the competition rules"""
-    kill = await get_kill(session, kill_id, kill_hash)
+# Everything about a kill that does not depend on the pilot it is scored for
+KillFactors = namedtuple("KillFactors", ["kill_id", "kill_time", "time_bracket", "scored", "victim_points",
+                                         "attackers", "meta_factor"])
+
+# Kill factors by rules version and kill, shared by all pilots on a kill
+kill_factors_cache = Cache("kill_factors", maxsize=50000)
+
+# Meta level factor by kill, independent of the rules
+meta_factor_cache = Cache("meta_factor", maxsize=100000)
+
+
+async def get_meta_factor(session, kill):
+    found, factor = meta_factor_cache.get(kill["killmail_id"])
+    if not found:
+        factor = meta_level_factor(await get_average_meta_level(session, kill))
+        meta_factor_cache.set(kill["killmail_id"], factor)
+    return factor
+
+
+async def get_kill_factors(session, kill_id, kill_hash, rules, kill=None):
+    """Fetch a single kill from ESI and calculate everything about its score that does not depend on the pilot"""
+    found, factors = kill_factors_cache.get((rules.version, kill_id))
+    if found:
+        return factors
+
+    if kill is None:
+        kill = await get_kill(session, kill_id, kill_hash)
 
     kill_time = datetime.strptime(kill['killmail_time'], '%Y-%m-%dT%H:%M:%SZ')
     time_bracket = stapling_time(kill, rules)
 
-    if not rules.season.start < kill_time < rules.season.end:
-        return kill_id, kill_time, 0, time_bracket
+    scored = rules.season.start < kill_time < rules.season.end and kill_is_valid(kill)
+    if scored:
+        # Base points of every player on the kill, in order
+        victim_points = rules.rarity_adjusted(kill.get("victim", {}))
+        attackers = [(int(attacker["character_id"]), attacker, rules.base(attacker))
+                     for attacker in kill.get("attackers", []) if "character_id" in attacker]
+        meta_factor = await get_meta_factor(session, kill)
+    else:
+        victim_points, attackers, meta_factor = None, [], None
 
-    if not kill_is_valid(kill):
-        return kill_id, kill_time, 0, time_bracket
+    factors = KillFactors(kill_id, kill_time, time_bracket, scored, victim_points, attackers, meta_factor)
+    kill_factors_cache.set((rules.version, kill_id), factors)
+    return factors
 
-    # ATTACKERS / VICTIM CALCULATION
-    # Calculate points of each category
-    rarity_adjusted_victim_points = rules.rarity_adjusted(kill.get("victim", {}))
+
+def pilot_score(factors, rules, main_character_id=None):
+    """Score of a kill for one pilot, given the factors of the kill"""
+    if not factors.scored:
+        return 0
 
     standard_points = []
     risk_adjusted_pilot_points = None
@@ -146,74 +209,171 @@ async def get_kill_score(session, kill_id, kill_hash, rules, main_character_id=N
     # The protagonist must fly some ship, otherwise 0 points, and only player characters count
     # Helpers get added as "unknown ship" if we can't figure out what they fly.
     if main_character_id:
-        for attacker in kill.get("attackers", []):
-            if "character_id" in attacker:
-                if int(attacker["character_id"]) == main_character_id:
-                    if "ship_type_id" in attacker:
-                        risk_adjusted_pilot_points = rules.risk_adjusted(attacker)
-                else:
-                    standard_points.append(rules.base(attacker))
+        for character_id, attacker, standard_point in factors.attackers:
+            if character_id == main_character_id:
+                if "ship_type_id" in attacker:
+                    risk_adjusted_pilot_points = rules.risk_adjusted(attacker)
+            else:
+                standard_points.append(standard_point)
 
     # If we don't have a clear protagonist, we have to assign one
     # First we collect all the points without protagonist, and use the risk adjusted point
     # To collect the difference (negative) if a guy were the protagonist
     else:
         risk_adjusted_pilot_points = 0
-        for attacker in kill.get("attackers", []):
-            if "character_id" in attacker:
-                standard_point = rules.base(attacker)
-                risk_point = rules.risk_adjusted(attacker)
-                standard_points.append(standard_point)
-                if risk_point and standard_point:
-                    risk_adjusted_pilot_points = min(risk_adjusted_pilot_points, risk_point - standard_point)
+        for character_id, attacker, standard_point in factors.attackers:
+            risk_point = rules.risk_adjusted(attacker)
+            standard_points.append(standard_point)
+            if risk_point and standard_point:
+                risk_adjusted_pilot_points = min(risk_adjusted_pilot_points, risk_point - standard_point)
 
     # Combine points into preliminary score
     try:
-        kill_score = 10 * rarity_adjusted_victim_points / (risk_adjusted_pilot_points + sum(standard_points))
+        kill_score = 10 * factors.victim_points / (risk_adjusted_pilot_points + sum(standard_points))
     except (ZeroDivisionError, ValueError, TypeError):
-        logger.debug(f"Could not calculate score for kill {kill_id}")
+        logger.debug(f"Could not calculate score for kill {factors.kill_id}")
         kill_score = 0
 
-    logger.info(f"Kill {kill_id} is worth {kill_score} points.")
-    kill_score = await scale_score_on_meta_level(kill_score, session, kill)
+    logger.info(f"Kill {factors.kill_id} is worth {kill_score} points.")
+
+    # Apply meta level factor to score
+    kill_score *= factors.meta_factor
+
+    return kill_score
+
+
+async def get_kill_score(session, kill_id, kill_hash, rules, main_character_id=None, kill=None):
+    """Fetch a single kill from ESI and calculate it's score according to the competition rules"""
+    factors = await get_kill_factors(session, kill_id, kill_hash, rules, kill)
+    return kill_id, factors.kill_time, pilot_score(factors, rules, main_character_id), factors.time_bracket
+
+
+def score_cache_key(rules, kill_id, main_character_id):
+    return rules.version, kill_id, main_character_id or 0
+
+
+def load_kill_scores(rules, character_id, kill_ids):
+    """Bulk read persisted scores of the current rules version into the score cache"""
+    missing = [k for k in kill_ids if score_cache_key(rules, k, character_id) not in score_cache]
+    for kill_id_chunk in chunked(missing, 500):
+        query = KillScore.select().where((KillScore.rules_version == rules.version) &
+                                         (KillScore.character_id == (character_id or 0)) &
+                                         (KillScore.kill_id.in_(kill_id_chunk)))
+        for row in query:
+            score_cache.set(score_cache_key(rules, row.kill_id, character_id),
+                            (row.kill_id, row.kill_time, row.score, timedelta(seconds=row.time_bracket)))
 
-    return kill_id, kill_time, kill_score, time_bracket
 
+def store_kill_scores(rules, character_id, kill_scores):
+    """Persist scores so that they survive restarts as long as the rules do not change"""
+    rows = [{"rules_version": rules.version, "character_id": character_id or 0, "kill_id": kill_id,
+             "kill_time": kill_time, "score": kill_score, "time_bracket": time_bracket.total_seconds()}
+            for kill_id, kill_time, kill_score, time_bracket in kill_scores]
+    with db.atomic():
+        for batch in chunked(rows, 100):
+            KillScore.replace_many(batch).execute()
 
-async def get_kill_score_cached(session, kill_id, kill_hash, rules, main_character_id=None):
-    """Cache kill score based on kill_id and main_character_id"""
 
-    cache_key = (kill_id, main_character_id)
+def prune_kill_scores(rules):
+    """Remove persisted scores and groups of old rules versions"""
+    KillScore.delete().where(KillScore.rules_version != rules.version).execute()
+    ScoreGroup.delete().where(ScoreGroup.rules_version != rules.version).execute()
 
-    if cache_key in score_cache_dict:
-        return score_cache_dict[cache_key]
 
-    result = await get_kill_score(session, kill_id, kill_hash, rules, main_character_id)
-    score_cache_dict[cache_key] = result
+def apply_rule_change(rules, old_version, changed_type_ids):
+    """
+    Carry the scores of all kills without a changed type over to the new rules version,
+    and expire the entries with an affected kill, so that only those get rescored and re-totaled.
+    """
+    if old_version is None:
+        return
+
+    affected_query = KillType.select(KillType.kill_id).where(KillType.type_id.in_(list(changed_type_ids)))
+    affected_kills = {row.kill_id for row in affected_query}
+
+    # Persisted scores
+    with db.atomic():
+        carried_over = KillScore.select(
+            Value(rules.version), KillScore.character_id, KillScore.kill_id, KillScore.kill_time,
+            KillScore.score, KillScore.time_bracket
+        ).where((KillScore.rules_version == old_version) & (KillScore.kill_id.not_in(affected_query)))
+        KillScore.insert_from(carried_over, [
+            KillScore.rules_version, KillScore.character_id, KillScore.kill_id, KillScore.kill_time,
+            KillScore.score, KillScore.time_bracket
+        ]).on_conflict_ignore().execute()
+
+    # Cached scores
+    for (version, kill_id, character_id), (_, result) in list(score_cache.data.items()):
+        if version == old_version and kill_id not in affected_kills:
+            score_cache.set((rules.version, kill_id, character_id), result)
+
+    # Entries that need to be re-totaled
+    affected_characters = CharacterKill.select(CharacterKill.character_id).where(
+        CharacterKill.kill_id.in_(affected_query))
+    updated = Entry.update(points_expiry=datetime.utcnow()).where(
+        (Entry.season == rules.season) &
+        (Entry.character_id.in_([str(row.character_id) for row in affected_characters.distinct()]))
+    ).execute()
+
+    logger.info(f"Rule change affects {len(affected_kills)} kills and {updated} entries.")
+
+
+async def get_kill_score_cached(session, kill_id, kill_hash, rules, main_character_id=None, kill=None):
+    """Cache kill score based on rules version, kill_id and main_character_id"""
+
+    cache_key = score_cache_key(rules, kill_id, main_character_id)
+
+    found, result = score_cache.get(cache_key)
+    if found:
+        return result
+
+    result = await get_kill_score(session, kill_id, kill_hash, rules, main_character_id, kill)
+    score_cache.set(cache_key, result)
     return result
 
 
-async def get_kill_scores(session, rules, character_id):
-    """Fetch all kills for a character in a given time frame"""
+async def get_unscored_kills(session, rules, character_id, kills):
+    """Fetch the killmails of all kills that are not scored yet for a character, in one bulk lookup"""
+    load_kill_scores(rules, character_id, kills.keys())
+    unscored_kills = {k: h for k, h in kills.items() if score_cache_key(rules, k, character_id) not in score_cache}
+    return await get_kills(session, unscored_kills)
+
 
-    kills = await get_kill_pages(session, character_id, start=rules.season.start)
+async def get_kill_scores(session, rules, character_id, kills=None, kill_data=None):
+    """Fetch all kills for a character in a given time frame.
+    Already discovered kills and fetched killmails can be passed in to skip those steps."""
+
+    if kills is None:
+        kills = await get_kill_pages(session, character_id, start=rules.season.start)
+
+    if kill_data is None:
+        kill_data = await get_unscored_kills(session, rules, character_id, kills)
 
-    # Find all kills that are already in cache
     tasks = []
     for kill_id, kill_hash in kills.items():
-        tasks.append(get_kill_score_cached(session, kill_id, kill_hash, rules, character_id))
+        tasks.append(get_kill_score_cached(session, kill_id, kill_hash, rules, character_id, kill_data.get(kill_id)))
 
     # Fetch scores
     usable_kills = []
     for values in await asyncio.gather(*tasks):
         usable_kills.append(values)
 
+    # Persist all newly calculated scores at once
+    store_kill_scores(rules, character_id, [values for values in usable_kills if values[0] in kill_data])
+
     return usable_kills
 
 
+# Stapled groups by rules version and character, updated with new kills instead of rebuilt
+kill_groups_cache = Cache("kill_groups", maxsize=2000)
+
+
+@cached("collated_scores", maxsize=1000, ttl=60,
+        key=lambda rules, character_id: (rules.season.name, int(character_id), rules.version))
 async def get_collated_scores(session, rules, character_id):
     """
     Fetch all kills of a character for some period from zkill and do point calculation
+    Concurrent calls for the same character share one calculation, and its result for a minute.
     """
 
     logger.info(f"Starting fetch for character {character_id}.")
@@ -225,42 +385,166 @@ async def get_collated_scores(session, rules, character_id):
 
     logger.debug(f"fetched {len(kill_scores)} kills for {character_id}")
 
-    # Group kills based on their time bracket
-    groups = {}
-    last_time = None
-    last_id = None
-    for kill_id, kill_time, kill_score, time_bracket in sorted(kill_scores, key=lambda x: x[0]):
-        if kill_score > 0:
-            if last_time and kill_time - time_bracket < max(last_time):
-                groups[last_id].append((kill_id, kill_score))
-                last_time.append(kill_time)
-            else:
-                last_id = kill_id
-                last_time = [kill_time]
-                groups[last_id] = [(kill_id, kill_score)]
-
-    # Now figure out the scores of the stapled kills.
-    # Meta-parameter
-    max_multiplier = 2  # How much more a kill can be worth if you kill multiple
-
-    score_groups = []
-    for last_id, kills in groups.items():
-        stapled_score = 0
-        for i, (kill_id, kill_score) in enumerate(kills):
-            # Geometric sum style formula e.g. for 2 results in 1, 1.5, 1.75, 1.875 ... 2 - e
-            multiplier = max_multiplier - max_multiplier ** -i
-            logger.debug(f"Group {last_id} multiplier {multiplier}.")
-            stapled_score += kill_score * multiplier
-        score_groups.append((stapled_score, kills))
+    return collate_character_scores(rules, character_id, kill_scores)
 
+
+def collate_character_scores(rules, character_id, kill_scores):
+    """Update the stapled groups of a character with its kill scores and persist them"""
+    kill_groups = get_kill_groups(rules, character_id)
+    score_groups = collate_scores(kill_scores, kill_groups)
+    save_kill_groups(rules, character_id, kill_groups)
     return score_groups
 
 
+def get_kill_groups(rules, character_id):
+    found, kill_groups = kill_groups_cache.get((rules.version, character_id))
+    if not found:
+        kill_groups = load_kill_groups(rules, character_id)
+        kill_groups_cache.set((rules.version, character_id), kill_groups)
+    return kill_groups
+
+
+def load_kill_groups(rules, character_id):
+    """Restore the groups of a character from the persisted score state.
+    Scores are persisted before they are grouped, so only kills in a persisted group count as grouped already,
+    all other scoring kills are regrouped on the next update."""
+    kill_groups = KillGroups()
+
+    group_rows = list(ScoreGroup.select().where((ScoreGroup.rules_version == rules.version) &
+                                                (ScoreGroup.character_id == character_id)
+                                                ).order_by(ScoreGroup.first_kill_id))
+    if len(group_rows) == 0:
+        return kill_groups
+
+    for row in group_rows:
+        kill_groups.groups.append([row.end_time, row.score, [tuple(kill) for kill in json.loads(row.kills)]])
+        kill_groups.starts.append(row.first_kill_id)
+    grouped = {kill_id for _, _, kills in kill_groups.groups for kill_id, _ in kills}
+
+    # Kills without a positive score are never in a group, so they are known as well
+    for row in KillScore.select().where((KillScore.rules_version == rules.version) &
+                                        (KillScore.character_id == character_id)):
+        if row.kill_id in grouped or row.score <= 0:
+            kill_groups.kills[row.kill_id] = (row.kill_time, row.score, timedelta(seconds=row.time_bracket))
+    kill_groups.order = sorted(kill_groups.kills)
+    kill_groups.dirty_from = None
+
+    return kill_groups
+
+
+def save_kill_groups(rules, character_id, kill_groups):
+    """Persist only the groups that changed since the last save"""
+    if kill_groups.dirty_from is None:
+        return
+
+    rows = [{"rules_version": rules.version, "character_id": character_id, "first_kill_id": first_kill_id,
+             "end_time": end_time, "score": stapled_score, "kills": json.dumps(kills)}
+            for first_kill_id, (end_time, stapled_score, kills) in zip(kill_groups.starts, kill_groups.groups)
+            if first_kill_id >= kill_groups.dirty_from]
+
+    with db.atomic():
+        ScoreGroup.delete().where((ScoreGroup.rules_version == rules.version) &
+                                  (ScoreGroup.character_id == character_id) &
+                                  (ScoreGroup.first_kill_id >= kill_groups.dirty_from)).execute()
+        for batch in chunked(rows, 100):
+            ScoreGroup.insert_many(batch).execute()
+
+    kill_groups.dirty_from = None
+
+
+def get_stored_score_groups(rules, character_id, top=30):
+    """The best stapled groups of a character from the persisted score state, None if there is none"""
+    rows = ScoreGroup.select().where((ScoreGroup.rules_version == rules.version) &
+                                     (ScoreGroup.character_id == character_id)
+                                     ).order_by(ScoreGroup.score.desc()).limit(top)
+    if not rows.exists():
+        return None
+    return [(row.score, [tuple(kill) for kill in json.loads(row.kills)]) for row in rows]
+
+
+class KillGroups:
+    """
+    Kills of a character stapled together based on their time bracket.
+    Each group keeps the latest kill time in it, so grouping is linear after sorting.
+    Kills that are new or changed only regroup from the group they fall into onward.
+
+    Meta-parameter
+    - max_multiplier: How much more a kill can be worth if you kill multiple
+    """
+    max_multiplier = 2
+
+    def __init__(self):
+        self.kills = {}  # kill_id -> (kill_time, kill_score, time_bracket)
+        self.order = []  # all kill ids, sorted
+        self.groups = []  # [end_time, stapled_score, [(kill_id, kill_score), ...]]
+        self.starts = []  # first kill id of each group
+        self.dirty_from = None  # groups starting from this kill id changed since the last save
+
+    def update(self, kill_scores):
+        changed = [kill_id for kill_id, *values in kill_scores if self.kills.get(kill_id) != tuple(values)]
+        if len(changed) == 0:
+            return
+
+        new_ids = [kill_id for kill_id in changed if kill_id not in self.kills]
+        for kill_id, *values in kill_scores:
+            self.kills[kill_id] = tuple(values)
+
+        # New kills usually come after all known ones, which keeps order sorted without a resort
+        new_ids.sort()
+        if len(self.order) > 0 and len(new_ids) > 0 and new_ids[0] < self.order[-1]:
+            self.order = sorted(self.order + new_ids)
+        else:
+            self.order.extend(new_ids)
+
+        # Drop the group the first changed kill falls into and everything after it
+        index = max(bisect.bisect_right(self.starts, min(changed)) - 1, 0)
+        start_id = min(self.starts[index], min(changed)) if index < len(self.starts) else min(changed)
+        del self.groups[index:]
+        del self.starts[index:]
+        self.dirty_from = start_id if self.dirty_from is None else min(self.dirty_from, start_id)
+
+        for kill_id in self.order[bisect.bisect_left(self.order, start_id):]:
+            self.add(kill_id)
+
+    def add(self, kill_id):
+        kill_time, kill_score, time_bracket = self.kills[kill_id]
+        if kill_score <= 0:
+            return
+
+        if len(self.groups) > 0 and kill_time - time_bracket < self.groups[-1][0]:
+            group = self.groups[-1]
+            group[0] = max(group[0], kill_time)
+        else:
+            group = [kill_time, 0, []]
+            self.groups.append(group)
+            self.starts.append(kill_id)
+
+        # Geometric sum style formula e.g. for 2 results in 1, 1.5, 1.75, 1.875 ... 2 - e
+        multiplier = self.max_multiplier - self.max_multiplier ** -len(group[2])
+        group[1] += kill_score * multiplier
+        group[2].append((kill_id, kill_score))
+
+    def score_groups(self):
+        return [(stapled_score, kills) for _, stapled_score, kills in self.groups]
+
+
+def collate_scores(kill_scores, kill_groups=None):
+    """
+    Staple kills together based on their time bracket and calculate the score of each group.
+    Given the groups of earlier calls, only new or changed kills are regrouped.
+    """
+    if kill_groups is None:
+        kill_groups = KillGroups()
+
+    kill_groups.update(kill_scores)
+    return kill_groups.score_groups()
+
+
 def get_total_score(score_groups):
     """
     Sum up all the scores according to the competition rules
     """
     scores = [s for s, kills in score_groups]
-    total_score = sum(sorted(scores, reverse=True)[:30])
+    total_score = sum(heapq.nlargest(30, scores))
 
     return round(total_score, 2)
@@ -0,0 +1,38 @@
+import json
+import logging
+import sys
+
+from aiohttp import web
+
+# Configure the logger
+logger = logging.getLogger('discord.redisq_standin')
+logger.setLevel(logging.INFO)
+
+
+def create_app(packages):
+    """
+    Local stand-in for zkillboard's RedisQ, hands out the given packages one per listen.php call
+    and then {"package": null} like an idle feed. Point REDISQ_URL at it to test the live feed.
+    """
+    queue = list(packages)
+
+    async def handle_listen(request):
+        package = queue.pop(0) if len(queue) > 0 else None
+        if package is not None:
+            logger.info(f"Sending kill {package.get('killID')} to {request.query.get('queueID')}.")
+        return web.json_response({"package": package})
+
+    app = web.Application()
+    app.router.add_get("/listen.php", handle_listen)
+    return app
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    if len(sys.argv) not in [2, 3]:
+        print(f"Usage: {sys.argv[0]} packages.json [port]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        fixture = json.load(f)
+    web.run_app(create_app(fixture), host="127.0.0.1", port=int(sys.argv[2]) if len(sys.argv) == 3 else 8090)
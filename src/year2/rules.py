@@ -1,3 +1,7 @@
+import asyncio
+import hashlib
+import json
+import logging
 import os
 from datetime import datetime, timedelta
 
@@ -6,6 +10,10 @@ from google.oauth2 import service_account
 
 from network import get_item_name
 
+# Configure the logger
+logger = logging.getLogger('discord.rules')
+logger.setLevel(logging.INFO)
+
 
 class PointColumn:
     def __init__(self, location):
@@ -13,6 +21,7 @@ class PointColumn:
         self.location = location
         self.unknown_values = set()
         self.missing = set()
+        self.rows = 0
 
     def __call__(self, kill_fragment):
         type_id = kill_fragment.get("ship_type_id", 0)
@@ -23,12 +32,14 @@ class PointColumn:
                 self.missing.add(type_id)
             return None
 
-    def fetch(self, season, sheet):
-        """Fetch and parse one set of points from a spreadsheet"""
+    def range(self, season):
         end = chr(ord(self.location) + 1)
-        _range = f'{season.name}!{self.location}3:{end}'
-        result = sheet.values().get(spreadsheetId=os.environ["SPREADSHEET_ID"], range=_range).execute()
-        values = result.get('values', [])
+        return f'{season.name}!{self.location}3:{end}'
+
+    def parse(self, values):
+        """Parse one set of points as fetched from the spreadsheet"""
+        point_values = {}
+        unknown_values = set()
 
         for line in values:
             try:
@@ -40,34 +51,32 @@ class PointColumn:
                 try:
                     point_value = float(point_value.replace(",", "."))
                 except ValueError:
-                    self.unknown_values.add(item_id)
+                    unknown_values.add(item_id)
                 else:
-                    self.values[item_id] = point_value
+                    point_values[item_id] = point_value
 
-    async def write_back(self, season, sheet, session):
-        """For any values that could not be found, add a new entry to the spreadsheet"""
-        body = {'values': [[type_id, "TODO", await get_item_name(session, type_id)] for type_id in self.missing]}
+        self.values = point_values
+        self.unknown_values = unknown_values
+        self.rows = len(values)
 
-        result = sheet.values().get(spreadsheetId=os.environ["SPREADSHEET_ID"],
-                                    range=f'{season.name}!{self.location}3:{self.location}').execute()
-        values = result.get('values', [])
-        start_column = len(values) + 3
-        end_column = len(body["values"]) + start_column - 1
+    async def write_back_data(self, season, session):
+        """For any values that could not be found, build a new entry for the spreadsheet"""
+        if len(self.missing) == 0:
+            return None
 
+        body = [[type_id, "TODO", await get_item_name(session, type_id)] for type_id in self.missing]
+        start_column = self.rows + 3
+        end_column = len(body) + start_column - 1
         end = chr(ord(self.location) + 3)
 
-        sheet.values().update(
-            spreadsheetId=os.environ["SPREADSHEET_ID"],
-            range=f'{season.name}!{self.location}{start_column}:{end}{end_column}',
-            valueInputOption="USER_ENTERED", body=body
-        ).execute()
+        return {"range": f'{season.name}!{self.location}{start_column}:{end}{end_column}', "values": body}
 
-        self.missing = set()
+    def snapshot(self):
+        return {"values": self.values, "unknown_values": list(self.unknown_values)}
 
-    async def update(self, season, sheet, session):
-        """Fetch and write back"""
-        self.fetch(season, sheet)
-        await self.write_back(season, sheet, session)
+    def restore(self, snapshot):
+        self.values = {int(type_id): value for type_id, value in snapshot["values"].items()}
+        self.unknown_values = set(snapshot["unknown_values"])
 
 
 class RulesConnector:
@@ -80,20 +89,113 @@ class RulesConnector:
         self.time_adjusted = PointColumn("M")
 
         self.last_updated = None
+        self.version = None
+        self.listeners = []  # Called with (rules, old_version, changed_type_ids) when point values change
+        self.sheet = None
+        self.reload_task = None
 
-    async def update(self, session):
-        if self.last_updated is None or self.last_updated < datetime.now() - timedelta(minutes=5):
-            self.last_updated = datetime.now()
+        self.snapshot_file = f"data/rules_{season.name}.json"
+        self.load_snapshot()
+
+    @property
+    def columns(self):
+        return [self.base, self.rarity_adjusted, self.risk_adjusted, self.time_adjusted]
+
+    def fingerprint(self):
+        """Version of the rules, changes whenever any point value changes"""
+        data = json.dumps([sorted(column.values.items()) for column in self.columns])
+        return hashlib.sha1(data.encode()).hexdigest()[:16]
 
+    def load_snapshot(self):
+        """Start from the last rules that were loaded, so scoring does not have to wait for the spreadsheet"""
+        try:
+            with open(self.snapshot_file) as f:
+                snapshot = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return
+
+        for column, column_snapshot in zip(self.columns, snapshot["columns"]):
+            column.restore(column_snapshot)
+        self.version = snapshot["version"]
+        logger.info(f"Loaded rules version {self.version} from snapshot of {snapshot['saved']}.")
+
+    def save_snapshot(self):
+        snapshot = {
+            "version": self.version,
+            "saved": datetime.utcnow().isoformat(),
+            "columns": [column.snapshot() for column in self.columns]
+        }
+        with open(f"{self.snapshot_file}.tmp", "w") as f:
+            json.dump(snapshot, f)
+        os.replace(f"{self.snapshot_file}.tmp", self.snapshot_file)
+
+    def connect(self):
+        """Build the spreadsheet service, only done once"""
+        if self.sheet is None:
             scopes = ["https://www.googleapis.com/auth/drive", "https://www.googleapis.com/auth/drive.file",
                       "https://www.googleapis.com/auth/spreadsheets"]
             credentials = service_account.Credentials.from_service_account_file("credentials.json", scopes=scopes)
             service = discovery.build('sheets', 'v4', credentials=credentials)
-            sheet = service.spreadsheets()
+            self.sheet = service.spreadsheets()
+        return self.sheet
+
+    def fetch(self):
+        """Fetch all point columns in one request, blocking"""
+        result = self.connect().values().batchGet(
+            spreadsheetId=os.environ["SPREADSHEET_ID"], ranges=[column.range(self.season) for column in self.columns]
+        ).execute()
+        return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    def write_back(self, data):
+        """Write all new entries in one request, blocking"""
+        self.connect().values().batchUpdate(
+            spreadsheetId=os.environ["SPREADSHEET_ID"],
+            body={"valueInputOption": "USER_ENTERED", "data": data}
+        ).execute()
 
-            await self.base.update(self.season, sheet, session)
-            await self.rarity_adjusted.update(self.season, sheet, session)
-            await self.risk_adjusted.update(self.season, sheet, session)
-            await self.time_adjusted.update(self.season, sheet, session)
+    async def reload(self, session):
+        """Fetch and write back, the spreadsheet is only accessed from a worker thread"""
+        old_values = [column.values for column in self.columns]
+        for column, values in zip(self.columns, await asyncio.to_thread(self.fetch)):
+            column.parse(values)
+
+        old_version, self.version = self.version, self.fingerprint()
+        if old_version != self.version:
+            self.save_snapshot()
+
+            # Find the types whose value changed in any column
+            changed_type_ids = set()
+            for old_column_values, column in zip(old_values, self.columns):
+                for type_id in old_column_values.keys() | column.values.keys():
+                    if old_column_values.get(type_id) != column.values.get(type_id):
+                        changed_type_ids.add(type_id)
+
+            logger.info(f"Rules changed from {old_version} to {self.version} for {len(changed_type_ids)} types.")
+            for listener in self.listeners:
+                listener(self, old_version, changed_type_ids)
+
+        data = {column: await column.write_back_data(self.season, session) for column in self.columns}
+        data = {column: d for column, d in data.items() if d is not None}
+        if len(data) > 0:
+            await asyncio.to_thread(self.write_back, list(data.values()))
+
+            for column, column_data in data.items():
+                column.rows += len(column_data["values"])
+                column.missing -= {type_id for type_id, _, _ in column_data["values"]}
+
+    async def background_reload(self, session):
+        try:
+            await self.reload(session)
+        except Exception:
+            logger.error("Could not reload rules, keeping the previous version.", exc_info=True)
+
+    async def update(self, session):
+        if self.last_updated is None or self.last_updated < datetime.now() - timedelta(minutes=5):
+            self.last_updated = datetime.now()
 
-            service.close()
+            # Without any rules there is nothing to score with, so wait for them.
+            # Otherwise keep scoring with the current rules while fresh ones load.
+            if self.version is None:
+                await self.reload(session)
+            elif self.reload_task is None or self.reload_task.done():
+                self.reload_task = asyncio.create_task(self.background_reload(session))
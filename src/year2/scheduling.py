@@ -0,0 +1,108 @@
+import logging
+from datetime import datetime, timedelta
+
+from peewee import chunked
+
+from models import db, Entry, EntryActivity
+
+# Configure the logger
+logger = logging.getLogger('discord.scheduling')
+logger.setLevel(logging.INFO)
+
+# Kills in this time count as recent activity
+activity_window = timedelta(days=7)
+
+# Entries this high on the leaderboard are refreshed more often
+top_ranks = 10
+
+# Entries someone looked at in this time are refreshed more often
+query_window = timedelta(hours=2)
+
+
+def recent_kills(kill_scores, now=None):
+    """Number of scoring kills in the activity window, from (kill_id, kill_time, score, time_bracket) tuples"""
+    now = now or datetime.utcnow()
+    return sum(1 for _, kill_time, score, _ in kill_scores if score > 0 and kill_time > now - activity_window)
+
+
+def refresh_interval(max_delay, recent, rank, last_queried, now=None):
+    """
+    Time until the next refresh of an entry, between max_delay / 12 and 6 * max_delay
+    - Idle entries get the longest interval, every daily kill shortens it
+    - Entries at the top of the leaderboard and entries someone just looked at get refreshed more often
+    """
+    now = now or datetime.utcnow()
+    min_interval, max_interval = max_delay / 12, max_delay * 6
+
+    if recent == 0:
+        interval = max_interval
+    else:
+        interval = max_delay / (1 + recent / activity_window.days)
+
+    if rank < top_ranks:
+        interval /= 2
+
+    if last_queried is not None and now - last_queried < query_window:
+        interval /= 4
+
+    return min(max_interval, max(min_interval, interval))
+
+
+def schedule_entry(entry, max_delay, recent):
+    """Set the next refresh of a freshly refreshed entry, returns its activity to be stored"""
+    now = datetime.utcnow()
+    rank = Entry.select().where((Entry.season == entry.season) & (Entry.points > entry.points)).count()
+    activity = EntryActivity.get_or_none(EntryActivity.entry == entry)
+    last_queried = activity.last_queried if activity is not None else None
+
+    interval = refresh_interval(max_delay, recent, rank, last_queried, now)
+
+    logger.debug(f"Entry {entry.character_id} with {recent} recent kills at rank {rank + 1}, "
+                 f"next refresh in {interval}.")
+    entry.points_expiry = now + interval
+    return {"entry": entry, "recent_kills": recent, "rank": rank, "last_queried": last_queried,
+            "refreshed": now, "interval": interval}
+
+
+def store_refreshed_entries(entries, activities, max_delay):
+    """
+    Write the results of many refreshed entries in one transaction.
+    Entries looked at since they were scheduled are scheduled again with the newer query time,
+    and last_queried itself is only ever written by record_query.
+    """
+    with db.atomic():
+        queried = {row.entry_id: row.last_queried for row in EntryActivity.select().where(
+            EntryActivity.entry.in_([activity["entry"].id for activity in activities]))}
+        for activity in activities:
+            last_queried = queried.get(activity["entry"].id)
+            if last_queried is not None and (activity["last_queried"] is None or
+                                             last_queried > activity["last_queried"]):
+                activity["interval"] = refresh_interval(max_delay, activity["recent_kills"], activity["rank"],
+                                                        last_queried, activity["refreshed"])
+                activity["entry"].points_expiry = min(activity["entry"].points_expiry,
+                                                      activity["refreshed"] + activity["interval"])
+
+        Entry.bulk_update(entries, fields=[Entry.points, Entry.points_expiry], batch_size=100)
+        rows = [{"entry": activity["entry"].id, "recent_kills": activity["recent_kills"],
+                 "interval": activity["interval"].total_seconds()} for activity in activities]
+        for batch in chunked(rows, 100):
+            EntryActivity.insert_many(batch).on_conflict(
+                conflict_target=[EntryActivity.entry],
+                preserve=[EntryActivity.recent_kills, EntryActivity.interval]).execute()
+
+
+def record_query(season, character_id, max_delay):
+    """Note that someone looked at an entry, so it is refreshed sooner from now on"""
+    entry = season.entries.where(Entry.character_id == str(character_id)).first()
+    if entry is None:
+        return
+
+    now = datetime.utcnow()
+    EntryActivity.insert(entry=entry, last_queried=now).on_conflict(
+        conflict_target=[EntryActivity.entry], update={EntryActivity.last_queried: now}).execute()
+
+    # Pull the next refresh forward if it is further away than an entry that is looked at would wait
+    activity = EntryActivity.get(EntryActivity.entry == entry)
+    next_refresh = now + refresh_interval(max_delay, activity.recent_kills, top_ranks, now, now)
+    if entry.points_expiry > next_refresh:
+        Entry.update(points_expiry=next_refresh).where(Entry.id == entry.id).execute()
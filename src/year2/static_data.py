@@ -0,0 +1,65 @@
+import csv
+import logging
+import sys
+
+from peewee import chunked
+
+from models import db, initialize_database, ItemType
+from network import parse_item_type
+
+# Configure the logger
+logger = logging.getLogger('discord.static_data')
+logger.setLevel(logging.INFO)
+
+# Only attributes that end up in the type store are kept while reading the dump
+used_attributes = {12, 13, 14, 633, 1692}
+
+
+def read_attributes(attributes_file):
+    """Read the dogma attributes of every type from a dgmTypeAttributes.csv dump"""
+    attributes = {}
+    with open(attributes_file, newline="") as f:
+        for row in csv.DictReader(f):
+            attribute_id = int(row["attributeID"])
+            if attribute_id not in used_attributes:
+                continue
+
+            value = row["valueFloat"] if row["valueFloat"] not in ("", "None") else row["valueInt"]
+            try:
+                value = float(value)
+            except ValueError:
+                continue
+
+            attributes.setdefault(int(row["typeID"]), []).append({"attribute_id": attribute_id, "value": value})
+    return attributes
+
+
+def import_types(types_file, attributes_file):
+    """
+    Bulk load all types of a static data export (Fuzzwork invTypes.csv and dgmTypeAttributes.csv)
+    into the type store, so that scoring does not need to look up types from ESI.
+    """
+    attributes = read_attributes(attributes_file)
+
+    item_types = []
+    with open(types_file, newline="") as f:
+        for row in csv.DictReader(f):
+            type_id = int(row["typeID"])
+            item_types.append(parse_item_type(type_id, row["typeName"], attributes.get(type_id, [])))
+
+    with db.atomic():
+        for batch in chunked(item_types, 100):
+            ItemType.insert_many(batch).on_conflict_replace().execute()
+
+    logger.info(f"Imported {len(item_types)} types.")
+    return len(item_types)
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} invTypes.csv dgmTypeAttributes.csv")
+        sys.exit(1)
+
+    initialize_database()
+    import_types(sys.argv[1], sys.argv[2])
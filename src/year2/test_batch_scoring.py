@@ -0,0 +1,120 @@
+import asyncio
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime
+
+import batch_scoring
+import models
+import points
+from rules import PointColumn
+
+# Types used by the random killmails, 3885 is the CONCORD ship that makes kills invalid
+type_ids = list(range(1, 40))
+concord_ship_type = 3885
+
+
+class Season:
+    start = datetime(2024, 1, 1)
+    end = datetime(2024, 3, 1)
+
+
+class Rules:
+    """Point columns filled with random values, without a spreadsheet"""
+    season = Season()
+    version = "test"
+
+    def __init__(self, rng):
+        self.base = PointColumn("A")
+        self.rarity_adjusted = PointColumn("E")
+        self.risk_adjusted = PointColumn("I")
+        self.time_adjusted = PointColumn("M")
+
+        for column in [self.base, self.rarity_adjusted, self.risk_adjusted, self.time_adjusted]:
+            for type_id in type_ids:
+                r = rng.random()
+                if r < 0.005:
+                    continue  # Missing from the spreadsheet
+                if r < 0.01:
+                    column.unknown_values.add(type_id)  # Not a number in the spreadsheet
+                    continue
+                column.values[type_id] = rng.choice([0.0, rng.uniform(0.1, 100), float(rng.randint(1, 50)),
+                                                     -rng.uniform(0, 5) if rng.random() < 0.03 else 1.0])
+
+
+def random_kill(rng, kill_id):
+    attackers = []
+    for _ in range(rng.choice([0, 1, 2, 3, 5, 9, 20, 60])):
+        attacker = {}
+        if rng.random() < 0.9:
+            attacker["character_id"] = rng.choice([100, 101, 102, 103, 104, 105])
+        if rng.random() < 0.9:
+            attacker["ship_type_id"] = rng.choice(type_ids + ([concord_ship_type] if rng.random() < 0.02 else []))
+        attackers.append(attacker)
+
+    items = [{"flag": rng.randint(5, 40), "item_type_id": rng.choice(type_ids),
+              "quantity_destroyed": rng.choice([0, 1, 2]), "quantity_dropped": rng.choice([0, 1])}
+             for _ in range(rng.randint(0, 12))]
+
+    month = rng.choice(["01", "02", "03", "04"])
+    return {
+        "killmail_id": kill_id,
+        "killmail_time": f"2024-{month}-{rng.randint(10, 28)}T0{rng.randint(0, 9)}:00:00Z",
+        "solar_system_id": rng.choice([1, 2, 30000142]) if rng.random() < 0.1 else 5,
+        "victim": {"ship_type_id": rng.choice(type_ids), "items": items},
+        "attackers": attackers,
+    }
+
+
+class BatchScoringTest(unittest.TestCase):
+    """get_kill_scores_batch has to give exactly the same results as points.get_kill_score"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        models.db.init(os.path.join(cls.directory.name, "db.sqlite"))
+        models.initialize_database()
+
+        rng = random.Random(1)
+        cls.rules = Rules(rng)
+        for type_id in type_ids + [concord_ship_type]:
+            models.ItemType.replace(type_id=type_id, name=str(type_id),
+                                    meta_level=rng.choice([0.0, 1, 2, 3, 4, 5, 6, 8, 11.5]),
+                                    low_slots=rng.randint(0, 5), mid_slots=rng.randint(0, 4),
+                                    high_slots=rng.choice([0, 0, 3])).execute()
+        cls.kills = {kill_id: random_kill(rng, kill_id) for kill_id in range(1, 3000)}
+
+    @classmethod
+    def tearDownClass(cls):
+        models.db.close()
+        cls.directory.cleanup()
+
+    def check(self, main_character_id):
+        async def scores():
+            single = [await points.get_kill_score(None, kill_id, "hash", self.rules, main_character_id, kill)
+                      for kill_id, kill in self.kills.items()]
+            batch = await batch_scoring.get_kill_scores_batch(None, self.rules, self.kills, main_character_id)
+            return single, batch
+
+        single, batch = asyncio.run(scores())
+        self.assertEqual(len(single), len(batch))
+        self.assertGreater(sum(1 for result in single if result[2] != 0), 0)
+        for expected, result in zip(single, batch):
+            # Scores have to match bit for bit, only the type of a zero may differ
+            self.assertEqual(expected, result)
+            if expected[2] != 0:
+                self.assertEqual(repr(expected[2]), repr(result[2]))
+
+    def test_without_protagonist(self):
+        self.check(None)
+
+    def test_with_protagonist(self):
+        self.check(100)
+
+    def test_with_other_protagonist(self):
+        self.check(103)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import models
+import points
+
+
+class Rules:
+    version = "test"
+
+
+def kill_score(kill_id, minutes, score, bracket=10):
+    return kill_id, datetime(2024, 1, 1) + timedelta(minutes=minutes), score, timedelta(minutes=bracket)
+
+
+class KillGroupsTest(unittest.TestCase):
+    """Stapled groups restored after a restart have to total the same as groups built from scratch"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        models.db.init(os.path.join(self.directory.name, "db.sqlite"))
+        models.initialize_database()
+        points.kill_groups_cache.clear()
+        self.rules = Rules()
+
+    def tearDown(self):
+        models.db.close()
+        self.directory.cleanup()
+
+    def refresh(self, character_id, kill_scores):
+        """Persist the scores before collating them, like the refresh pipeline and the live feed do"""
+        points.store_kill_scores(self.rules, character_id, kill_scores)
+        return points.get_total_score(points.collate_character_scores(self.rules, character_id, kill_scores))
+
+    def restart(self):
+        points.kill_groups_cache.clear()
+
+    def test_new_kills_after_restart(self):
+        first = [kill_score(1, 0, 20.0)]
+        self.assertEqual(self.refresh(100, first), 20.0)
+
+        self.restart()
+        both = first + [kill_score(2, 600, 20.0)]
+        self.assertEqual(self.refresh(100, both), points.get_total_score(points.collate_scores(both)))
+        self.assertEqual(self.refresh(100, both), 40.0)
+
+        stored = points.get_stored_score_groups(self.rules, 100)
+        self.assertEqual(sorted(score for score, _ in stored), [20.0, 20.0])
+
+    def test_random_refreshes_with_restarts(self):
+        rng = random.Random(3)
+        for character_id in range(1, 30):
+            kill_scores = []
+            for kill_id in range(rng.randint(1, 60)):
+                kill_scores.append(kill_score(kill_id, rng.randint(0, 3000), rng.choice([-1.0, 0.0, 5.0, 12.5, 40.0]),
+                                              rng.choice([5, 30, 120])))
+
+            # The kills show up in a few refreshes, with restarts in between some of them
+            cuts = sorted(rng.sample(range(1, len(kill_scores)), min(3, len(kill_scores) - 1))) + [len(kill_scores)]
+            for cut in cuts:
+                if rng.random() < 0.5:
+                    self.restart()
+                total = self.refresh(character_id, kill_scores[:cut])
+                self.assertEqual(total, points.get_total_score(points.collate_scores(kill_scores[:cut])))
+
+            expected = points.collate_scores(kill_scores)
+            stored = points.get_stored_score_groups(self.rules, character_id, top=len(kill_scores))
+            self.assertEqual(sorted(score for score, _ in stored or []), sorted(score for score, _ in expected))
+
+
+if __name__ == "__main__":
+    unittest.main()